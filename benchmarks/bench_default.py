@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for the type dispatch of `ndb_json.NdbEncoder.default`.
+
+Compares the cost per `default()` call of the previous, uncached subclass lookup
+against the type-dispatch cache, for the kinds of values which miss the exact type table.
+
+Usage (with the App Engine SDK on the PYTHONPATH):
+
+  python benchmarks/bench_default.py --number 100000
+"""
+
+import argparse
+import datetime
+import timeit
+
+from google.appengine.ext import ndb
+
+from gaek import ndb_json
+
+
+class Entity(ndb.Model):
+  name = ndb.StringProperty()
+
+
+class MyDateTime(datetime.datetime):
+  pass
+
+
+def uncached_default(encoder, obj):
+  """The `default()` type lookup as it was before the type-dispatch cache."""
+  obj_type = type(obj)
+  if obj_type not in encoder._ndb_type_encoding:
+    if hasattr(obj, '__metaclass__'):
+      obj_type = obj.__metaclass__
+    else:
+      for ndb_type in ndb_json.NDB_TYPES:
+        if isinstance(obj, ndb_type):
+          obj_type = ndb_type
+          break
+  return encoder._ndb_type_encoding.get(obj_type)
+
+
+def cached_default(encoder, obj):
+  """The `default()` type lookup using the type-dispatch cache."""
+  obj_type = type(obj)
+  try:
+    return encoder._type_cache[obj_type]
+  except KeyError:
+    fn = encoder._type_cache[obj_type] = encoder._resolve_encoding(obj)
+    return fn
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--number', type=int, default=100000, help='Calls per measurement.')
+  parser.add_argument('--repeat', type=int, default=5, help='Measurements per case, the best is kept.')
+  args = parser.parse_args()
+
+  encoder = ndb_json.NdbEncoder()
+  cases = (
+      ('ndb.Model instance', Entity(name='name')),
+      ('datetime subclass', MyDateTime(2016, 1, 1)),
+      ('datetime', datetime.datetime(2016, 1, 1)),
+  )
+
+  print('%-20s %12s %12s %8s' % ('value', 'before (ns)', 'after (ns)', 'speedup'))
+  for name, obj in cases:
+    results = []
+    for fn in (uncached_default, cached_default):
+      timer = timeit.Timer(lambda: fn(encoder, obj))
+      best = min(timer.repeat(repeat=args.repeat, number=args.number))
+      results.append(best / args.number * 1e9)
+    before, after = results
+    print('%-20s %12.1f %12.1f %7.1fx' % (name, before, after, before / after))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the import time of `gaek`, `gaek.environ` and `gaek.ndb_json`, as paid on a cold start.
+
+Each import is timed in a fresh interpreter, so that no module is already loaded, and the
+modules it leaves in `sys.modules` are counted. The median of the runs is reported.
+
+Usage (with the App Engine SDK on the PYTHONPATH):
+
+  python benchmarks/bench_import.py --number 10 --output results.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+
+
+MODULES = ('gaek', 'gaek.environ', 'gaek.ndb_json')
+
+# Run in the child interpreter, which prints the seconds taken to import the module and the modules loaded.
+CHILD_SCRIPT = '''
+import sys
+import time
+before = set(sys.modules)
+start = time.time()
+__import__(%r)
+elapsed = time.time() - start
+print('%%r %%d' %% (elapsed, len(set(sys.modules) - before)))
+'''
+
+
+def time_import(module):
+  """Import `module` in a fresh interpreter, and return the seconds taken and the number of modules loaded."""
+  output = subprocess.check_output([sys.executable, '-c', CHILD_SCRIPT % module])
+  elapsed, loaded = output.split()
+  return float(elapsed), int(loaded)
+
+
+def run_case(module, args):
+  """Time the import of `module` over `args.number` runs, and return its results."""
+  runs = sorted(time_import(module) for _ in range(args.number))
+  elapsed, loaded = runs[len(runs) // 2]
+  result = {
+      'module': module,
+      'median_seconds': elapsed,
+      'min_seconds': runs[0][0],
+      'modules_loaded': loaded,
+  }
+  print('%-16s %10.4f s (min %.4f s) %6d modules' % (module, elapsed, runs[0][0], loaded))
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--number', type=int, default=5, help='Fresh interpreters per module.')
+  parser.add_argument('--output', help='Path of a JSON file to save the results to.')
+  args = parser.parse_args()
+
+  results = [run_case(module, args) for module in MODULES]
+
+  if args.output:
+    import gaek
+    with open(args.output, 'w') as fp:
+      json.dump({
+          'gaek_version': gaek.__version__,
+          'python_version': platform.python_version(),
+          'config': vars(args),
+          'results': results,
+      }, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for `ndb_json` encoding and decoding, against the local datastore stub.
+
+Builds synthetic Models of configurable width, StructuredProperty nesting, repeated values,
+blob size and KeyProperty fan-out, then reports for `dumps`, `dump`, `dump_parallel` and `loads`,
+and for each `ndb_keys_as_*` mode:
+
+  - throughput, in entities per second,
+  - datastore RPCs issued per run (by the benchmark process, so not those of `dump_parallel` workers),
+  - peak memory: the growth of the resident set size (ru_maxrss) during one run of the case, measured
+    in a forked child process, so that cases don't share the high-water mark of the benchmark process.
+
+Results can be saved as JSON, to compare gaek releases against each other.
+
+The local datastore stub answers RPCs at once, so `--rpc-latency` adds a delay to each of them,
+to approximate the latency of the production datastore.
+
+Usage (with the App Engine SDK on the PYTHONPATH):
+
+  python benchmarks/bench_ndb_json.py --entities 500 --width 20 --key-fanout 2 --output results.json
+  python benchmarks/bench_ndb_json.py --entities 2000 --workers 4 --rpc-latency 0.05
+"""
+
+import argparse
+import cStringIO
+import datetime
+import json
+import os
+import platform
+import resource
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import gaek
+from gaek import ndb_json
+
+
+class Target(ndb.Model):
+  """Entity referenced by the KeyProperty fan-out of the benchmark Models."""
+  name = ndb.StringProperty()
+  created = ndb.DateTimeProperty()
+
+
+def make_model(width, depth, repeated, blob_size, key_fanout):
+  """Build a Model class with the given shape. Each nesting level is a StructuredProperty."""
+  props = {}
+  for i in range(width):
+    props['string_%d' % i] = ndb.StringProperty()
+    props['integer_%d' % i] = ndb.IntegerProperty()
+  props['created'] = ndb.DateTimeProperty()
+  if repeated:
+    props['tags'] = ndb.StringProperty(repeated=True)
+  if blob_size:
+    props['blob'] = ndb.BlobProperty()
+  for i in range(key_fanout):
+    props['target_%d' % i] = ndb.KeyProperty(kind=Target)
+  if depth:
+    child = make_model(width, depth - 1, repeated, blob_size, 0)
+    props['child'] = ndb.StructuredProperty(child)
+  return type('Bench_w%d_d%d_r%d_b%d_k%d' % (width, depth, repeated, blob_size, key_fanout),
+              (ndb.Model,), props)
+
+
+def make_entity(model_class, index, args, targets):
+  """Build one entity of the benchmark Model, recursively filling its nested Models."""
+  values = {'created': datetime.datetime(2016, 1, 1) + datetime.timedelta(seconds=index)}
+  for name, prop in model_class._properties.iteritems():
+    if name.startswith('string_'):
+      values[name] = u'value %d of %s' % (index, name)
+    elif name.startswith('integer_'):
+      values[name] = index
+    elif name == 'tags':
+      values[name] = ['tag %d' % i for i in range(args.repeated)]
+    elif name == 'blob':
+      values[name] = ''.join(chr((index + i) % 256) for i in range(args.blob_size))
+    elif name.startswith('target_'):
+      values[name] = targets[(index + int(name[len('target_'):])) % len(targets)]
+    elif name == 'child':
+      values[name] = make_entity(prop._modelclass, index, args, targets)
+  return model_class(**values)
+
+
+class RpcCounter(object):
+  """Counts the datastore RPCs made through the API proxy, delaying each one by `latency` seconds."""
+
+  def __init__(self, latency=0.0):
+    self.count = 0
+    self.latency = latency
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('gaek_bench', self.hook, 'datastore_v3')
+
+  def hook(self, service, call, request, response):
+    self.count += 1
+    if self.latency:
+      time.sleep(self.latency)
+
+
+def clear_caches():
+  """Clear the NDB context cache, so that every run fetches its Keys from the datastore stub."""
+  ndb.get_context().clear_cache()
+
+
+def measure_peak_rss(fn):
+  """Run `fn` once in a forked child process, and return the growth of its peak resident set size, in KB.
+
+  A forked child starts with a peak of its current size, rather than the peak of its parent. Every case
+  is measured before any case is timed, so that all children start from the same state of the heap.
+  """
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.close(read_fd)
+      clear_caches()
+      start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      fn()
+      os.write(write_fd, str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss))
+    finally:
+      os._exit(0)
+  os.close(write_fd)
+  with os.fdopen(read_fd) as fp:
+    output = fp.read()
+  os.waitpid(pid, 0)
+  if not output:
+    raise RuntimeError('Peak memory measurement failed')
+  return int(output)
+
+
+def run_case(name, fn, args, rpc_counter, peak_rss_kb):
+  """Time `fn` over `args.number` runs, and return its results along with its peak memory."""
+  fn()  # Warm up caches which are not part of the measurement, such as compiled serializers.
+  start_rpcs = rpc_counter.count
+  elapsed = 0.0
+  for _ in range(args.number):
+    clear_caches()
+    start = time.time()
+    fn()
+    elapsed += time.time() - start
+  result = {
+      'case': name,
+      'seconds_per_run': elapsed / args.number,
+      'entities_per_second': args.entities * args.number / elapsed if elapsed else None,
+      'rpcs_per_run': (rpc_counter.count - start_rpcs) / float(args.number),
+      'peak_rss_kb': peak_rss_kb,
+  }
+  print('%-28s %10.4f s %12.1f ent/s %8.1f rpcs %8d KB' % (
+      name, result['seconds_per_run'], result['entities_per_second'] or 0,
+      result['rpcs_per_run'], result['peak_rss_kb']))
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--entities', type=int, default=200, help='Number of entities to encode.')
+  parser.add_argument('--width', type=int, default=10, help='String and integer properties per Model.')
+  parser.add_argument('--depth', type=int, default=1, help='Levels of StructuredProperty nesting.')
+  parser.add_argument('--repeated', type=int, default=5, help='Values of the repeated property.')
+  parser.add_argument('--blob-size', type=int, default=1024, help='Bytes in the BlobProperty.')
+  parser.add_argument('--key-fanout', type=int, default=2, help='KeyProperty properties per entity.')
+  parser.add_argument('--targets', type=int, default=50, help='Distinct entities referenced by Keys.')
+  parser.add_argument('--number', type=int, default=3, help='Runs per case.')
+  parser.add_argument('--page-size', type=int, default=ndb_json.STREAM_PAGE_SIZE,
+                      help='Results per page of dump ndb_stream and dump_parallel.')
+  parser.add_argument('--workers', type=int, default=4, help='Worker processes of dump_parallel.')
+  parser.add_argument('--rpc-latency', type=float, default=0.0, help='Seconds added to each datastore RPC.')
+  parser.add_argument('--case', action='append', help='Name of a case to run (all cases by default).')
+  parser.add_argument('--output', help='Path of a JSON file to save the results to.')
+  args = parser.parse_args()
+
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  ctx = ndb.get_context()
+  ctx.set_cache_policy(False)
+  ctx.set_memcache_policy(False)
+  rpc_counter = RpcCounter()
+
+  try:
+    targets = ndb.put_multi([
+        Target(name='target %d' % i, created=datetime.datetime(2016, 1, 1)) for i in range(args.targets)])
+    model_class = make_model(args.width, args.depth, args.repeated, args.blob_size, args.key_fanout)
+    ndb.put_multi([make_entity(model_class, i, args, targets) for i in range(args.entities)])
+    query = model_class.query()
+
+    # Decoding is measured on the output of ndb_keys_as_urlsafe, which ndb_model can decode.
+    json_str = ndb_json.dumps(query, ndb_keys_as_urlsafe=True)
+    # Only the measured cases are delayed.
+    rpc_counter.latency = args.rpc_latency
+
+    def dump(**kwargs):
+      fp = cStringIO.StringIO()
+      ndb_json.dump(query, fp, **kwargs)
+      fp.close()
+
+    def dump_parallel(**kwargs):
+      fp = cStringIO.StringIO()
+      ndb_json.dump_parallel(query, fp, workers=args.workers, **kwargs)
+      fp.close()
+
+    cases = (
+        ('dumps ndb_keys_as_entities', lambda: ndb_json.dumps(query)),
+        ('dumps ndb_keys_batched', lambda: ndb_json.dumps(query, ndb_keys_batched=True)),
+        ('dumps ndb_keys_memo', lambda: ndb_json.dumps(query, ndb_keys_memo=True)),
+        ('dumps ndb_keys_as_pairs', lambda: ndb_json.dumps(query, ndb_keys_as_pairs=True)),
+        ('dumps ndb_keys_as_urlsafe', lambda: ndb_json.dumps(query, ndb_keys_as_urlsafe=True)),
+        ('dumps ndb_keys_as_interned', lambda: ndb_json.dumps(query, ndb_keys_as_interned=True)),
+        ('dump', lambda: dump(ndb_keys_as_urlsafe=True)),
+        ('dump ndb_stream', lambda: dump(ndb_keys_as_urlsafe=True, ndb_stream=True, ndb_page_size=args.page_size)),
+        ('dump_parallel', lambda: dump_parallel(ndb_keys_as_urlsafe=True, ndb_page_size=args.page_size)),
+        ('loads', lambda: ndb_json.loads(json_str)),
+        ('loads ndb_model', lambda: ndb_json.loads(json_str, ndb_model=model_class)),
+    )
+    if args.case:
+      cases = [(name, fn) for name, fn in cases if name in args.case]
+    peak_rss_kbs = [measure_peak_rss(fn) for _, fn in cases]
+    results = [run_case(name, fn, args, rpc_counter, peak_rss_kb)
+               for (name, fn), peak_rss_kb in zip(cases, peak_rss_kbs)]
+  finally:
+    bed.deactivate()
+
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump({
+          'gaek_version': gaek.__version__,
+          'python_version': platform.python_version(),
+          'config': vars(args),
+          'json_bytes': len(json_str),
+          'results': results,
+      }, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main()
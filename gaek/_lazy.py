@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to defer the import of heavy modules until they are first used.
+"""
+
+__author__ = 'Eric Higgins'
+__copyright__ = 'Copyright 2013-2016, Eric Higgins'
+__email__ = 'erichiggins@gmail.com'
+
+
+import importlib
+import pkgutil
+
+
+__all__ = (
+    'is_installed',
+    'LazyFunction',
+    'LazyModule',
+)
+
+
+def is_installed(name):
+  """True if the module `name` can be imported, without importing it."""
+  try:
+    return pkgutil.find_loader(name) is not None
+  except ImportError:
+    return False
+
+
+class LazyModule(object):
+  """Stands in for a module, which is imported on first attribute access.
+
+  When `optional` is True, `_lazy_load()` returns None instead of raising ImportError if the module is missing.
+  """
+
+  def __init__(self, name, optional=False):
+    self._lazy_name = name
+    self._lazy_optional = optional
+    self._lazy_module = None
+
+  def _lazy_load(self):
+    """Import the module, if it wasn't already, and return it."""
+    if self._lazy_module is None:
+      try:
+        self._lazy_module = importlib.import_module(self._lazy_name)
+      except ImportError:
+        if not self._lazy_optional:
+          raise
+        return None
+    return self._lazy_module
+
+  def __getattr__(self, name):
+    if name.startswith('_lazy_'):
+      raise AttributeError(name)
+    module = self._lazy_load()
+    if module is None:
+      raise AttributeError('Module %s is not installed' % self._lazy_name)
+    return getattr(module, name)
+
+  def __repr__(self):
+    return '<LazyModule %r>' % self._lazy_name
+
+
+class LazyFunction(object):
+  """Stands in for a function, which is resolved by calling `resolve` on first use.
+
+  Compares equal to the function it resolves to.
+  """
+
+  def __init__(self, resolve):
+    self._resolve = resolve
+    self._fn = None
+
+  def _lazy_get(self):
+    """Resolve the function, if it wasn't already, and return it."""
+    if self._fn is None:
+      self._fn = self._resolve()
+    return self._fn
+
+  def __call__(self, *args, **kwargs):
+    return self._lazy_get()(*args, **kwargs)
+
+  def __eq__(self, other):
+    if isinstance(other, LazyFunction):
+      other = other._lazy_get()
+    return self._lazy_get() == other
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self._lazy_get())
+
+  def __getattr__(self, name):
+    if name in ('_resolve', '_fn'):
+      raise AttributeError(name)
+    return getattr(self._lazy_get(), name)
+
+  def __repr__(self):
+    return '<LazyFunction %r>' % (self._fn or self._resolve)
@@ -26,15 +26,18 @@ __email__ = 'erichiggins@gmail.com'
 
 
 import os
+import sys
+import threading
+import time
 import warnings
 
-from google.appengine.api import app_identity
-from google.appengine.api import modules
+from gaek._lazy import LazyFunction, LazyModule
 
-try:
-  from google.appengine.api import namespace_manager
-except ImportError:
-  namespace_manager = None
+# The API modules are imported on first use, so that importing gaek.environ stays cheap on cold starts.
+app_identity = LazyModule('google.appengine.api.app_identity')
+modules = LazyModule('google.appengine.api.modules')
+# The namespace_manager API has been deprecated, and is missing from newer SDKs.
+namespace_manager = LazyModule('google.appengine.api.namespace_manager', optional=True)
 
 
 __all__ = (
@@ -57,6 +60,7 @@ __all__ = (
     'get_dot_target_name',
     'get_dot_target_name_safe',
     'get_environ_dict',
+    'get_environ_dict_async',
     'is_host_google',
     'is_development',
     'is_staging',
@@ -65,69 +69,165 @@ __all__ = (
     'is_production_safe',
     'is_default_version',
     'is_default_version_safe',
+    'get_application_id_safe',
+    'get_current_instance_id_safe',
     'get_current_module_name_safe',
-    'get_current_version_name_safe'
+    'get_current_version_name_safe',
+    'get_default_version_hostname_safe',
+    'refresh',
+    'warmup',
 )
 
 
 _UNDEFINED = '_UNDEFINED_'
 
+# Seconds for which the default version is cached, since it changes when traffic is migrated.
+DEFAULT_VERSION_TTL = 60
 
-# App Identity functions.
-get_application_id = app_identity.get_application_id
-get_default_version_hostname = app_identity.get_default_version_hostname
-get_service_account_name = app_identity.get_service_account_name
+# Snapshot of environment values which need an RPC to look up, as {name: (value, expiry time or None)}.
+_snapshot = {}
 
 
-# Module functions.
-get_current_instance_id = modules.get_current_instance_id
-get_current_module_name = modules.get_current_module_name
-get_current_version_name = modules.get_current_version_name
-get_default_version = modules.get_default_version
-get_hostname = modules.get_hostname
-get_modules = modules.get_modules
-get_versions = modules.get_versions
+# App Identity functions.
+get_application_id = LazyFunction(lambda: app_identity.get_application_id)
+get_default_version_hostname = LazyFunction(lambda: app_identity.get_default_version_hostname)
+get_service_account_name = LazyFunction(lambda: app_identity.get_service_account_name)
 
 
-# Namespace functions.
-if namespace_manager == None:
-  get_namespace = deprecated_fn
-  google_apps_namespace = deprecated_fn
-else:
-  get_namespace = namespace_manager.get_namespace
-  google_apps_namespace = namespace_manager.google_apps_namespace
+# Module functions.
+get_current_instance_id = LazyFunction(lambda: modules.get_current_instance_id)
+get_current_module_name = LazyFunction(lambda: modules.get_current_module_name)
+get_current_version_name = LazyFunction(lambda: modules.get_current_version_name)
+get_default_version = LazyFunction(lambda: modules.get_default_version)
+get_hostname = LazyFunction(lambda: modules.get_hostname)
+get_modules = LazyFunction(lambda: modules.get_modules)
+get_versions = LazyFunction(lambda: modules.get_versions)
 
 
 def deprecated_fn():
   warnings.warn('deprecated', DeprecationWarning)
 
 
+def _get_namespace_fn(name):
+  """Return a namespace_manager function, or deprecated_fn if the API is not available."""
+  if namespace_manager._lazy_load() is None:
+    return deprecated_fn
+  return getattr(namespace_manager, name)
+
+
+# Namespace functions.
+get_namespace = LazyFunction(lambda: _get_namespace_fn('get_namespace'))
+google_apps_namespace = LazyFunction(lambda: _get_namespace_fn('google_apps_namespace'))
+
+
 # Helper functions.
-def get_current_version_name_safe():
-  """Returns the current version of the app, or None if there is no current version found."""
+def _get_cached(name, fn, ttl=None):
+  """Return the snapshot value of `name`, calling `fn` when it is missing or older than `ttl` seconds."""
+  now = time.time()
+  entry = _snapshot.get(name)
+  if entry is not None and (entry[1] is None or entry[1] > now):
+    return entry[0]
+  value = fn()
+  _snapshot[name] = (value, None if ttl is None else now + ttl)
+  return value
+
+
+def _get_default_version_cached():
+  """Returns the default version of the current module, cached for DEFAULT_VERSION_TTL seconds."""
+  return _get_cached('get_default_version', modules.get_default_version, DEFAULT_VERSION_TTL)
+
+
+def _get_hostname_cached():
+  """Returns the hostname of the current instance, which does not change for its lifetime."""
+  return _get_cached('get_hostname', modules.get_hostname)
+
+
+def _get_frozen(name, fn):
+  """Return the value of `name` frozen by warmup(), or call `fn` when there is none."""
+  entry = _snapshot.get(name)
+  if entry is None:
+    return fn()
+  return entry[0]
+
+
+def _call_safe(fn):
+  """Call an API function which reads os.environ, returning None if the variable is missing."""
   try:
-    return modules.get_current_version_name()
+    return fn()
   except KeyError:
     return None
 
 
+def refresh():
+  """Clear the snapshot of cached environment values, so that they are looked up again on next use."""
+  _snapshot.clear()
+
+
+def warmup():
+  """Resolve and freeze the environment values which are constant for the life of the instance.
+
+  Call this from the /_ah/warmup handler, so that the first requests of an instance don't pay for these lookups.
+  The *_safe helpers, is_host_google() and is_development() then read the frozen values, until refresh().
+  Returns a dictionary of the frozen values.
+  """
+  facts = {
+      'get_application_id': _call_safe(app_identity.get_application_id),
+      'get_current_module_name': _call_safe(modules.get_current_module_name),
+      'get_current_version_name': _call_safe(modules.get_current_version_name),
+      'get_current_instance_id': _call_safe(modules.get_current_instance_id),
+      'get_default_version_hostname': _call_safe(app_identity.get_default_version_hostname),
+      'is_host_google': _is_host_google(),
+      'is_development': _is_development(),
+  }
+  for name, value in facts.iteritems():
+    # Missing values are left to be looked up again, rather than frozen as None.
+    if value is not None:
+      _snapshot[name] = (value, None)
+  # Also cache the default version ahead of the first request.
+  _get_default_version_cached()
+  return facts
+
+
+def get_current_version_name_safe():
+  """Returns the current version of the app, or None if there is no current version found."""
+  return _get_frozen('get_current_version_name', lambda: _call_safe(modules.get_current_version_name))
+
+
 def get_current_module_name_safe():
   """Returns the current module of the app, or None if there is no current module found.."""
-  try:
-    return modules.get_current_module_name()
-  except KeyError:
-    return None
+  return _get_frozen('get_current_module_name', lambda: _call_safe(modules.get_current_module_name))
+
+
+def get_current_instance_id_safe():
+  """Returns the id of the current instance, or None if there is no current instance found."""
+  return _get_frozen('get_current_instance_id', lambda: _call_safe(modules.get_current_instance_id))
+
+
+def get_application_id_safe():
+  """Returns the id of the app, or None if there is no app id found."""
+  return _get_frozen('get_application_id', lambda: _call_safe(app_identity.get_application_id))
+
+
+def get_default_version_hostname_safe():
+  """Returns the hostname of the default version of the app, or None if there is no hostname found."""
+  return _get_frozen('get_default_version_hostname',
+                     lambda: _call_safe(app_identity.get_default_version_hostname))
+
+
+def _is_host_google():
+  """True if the app is being hosted from Google App Engine servers, ignoring warmup()."""
+  return os.environ.get('SERVER_SOFTWARE', '').startswith('Google') or _get_hostname_cached().endswith('.appspot.com')
 
 
 def is_host_google():
   """True if the app is being hosted from Google App Engine servers."""
-  return os.environ.get('SERVER_SOFTWARE', '').startswith('Google') or get_hostname().endswith('.appspot.com')
+  return _get_frozen('is_host_google', _is_host_google)
 
 
 def is_default_version(version=None):
   """True if the current or specified app version is the default."""
   version = version or get_current_version_name()
-  return version == get_default_version()
+  return version == _get_default_version_cached()
 
 
 def is_default_version_safe(version=None):
@@ -136,12 +236,17 @@ def is_default_version_safe(version=None):
   Returns False when there is no version found.
   """
   version = version or get_current_version_name_safe()
-  return version == get_default_version()
+  return version == _get_default_version_cached()
+
+
+def _is_development():
+  """True if the dev_appserver is running, ignoring warmup()."""
+  return os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
 
 
 def is_development():
   """True if the dev_appserver is running (localhost or local development server)."""
-  return os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+  return _get_frozen('is_development', _is_development)
 
 
 def is_staging(version=None):
@@ -189,77 +294,137 @@ def get_dot_target_name_safe(version=None, module=None):
   return None
 
 
-def _get_os_environ_dict(keys):
-  """Return a dictionary of key/values from os.environ."""
-  return {k: os.environ.get(k, _UNDEFINED) for k in keys}
-
-
-def _get_app_identity_dict(keys):
-  """Return a dictionary of key/values from the app_identity module functions."""
-  return {k: getattr(app_identity, k)() for k in keys}
-
-
-def _get_modules_dict(keys):
-  """Return a dictionary of key/values from the modules module functions."""
-  return {k: getattr(modules, k)() for k in keys}
-
-
-def _get_namespace_manager_dict_v2(keys):
-  """Returns an empty dictionary since the namespace_manager API has been deprecated."""
-  return {}
-
-
-def _get_namespace_manager_dict_v1(keys):
-  """Return a dictionary of key/values from the namespace_manager module functions."""
-  return {k: getattr(namespace_manager, k)() for k in keys}
+# Keys reported by get_environ_dict, by source. Sources other than os.environ are API modules,
+# and their keys are the names of the module functions to call.
+ENVIRON_KEYS = (
+    ('os.environ', (
+        'AUTH_DOMAIN',
+        'CURRENT_CONFIGURATION_VERSION',
+        'CURRENT_MODULE_ID',
+        'CURRENT_VERSION_ID',
+        'DEFAULT_VERSION_HOSTNAME',
+        'FEDERATED_IDENTITY',
+        'FEDERATED_PROVIDER',
+        'GAE_LOCAL_VM_RUNTIME',
+        'HTTP_HOST',
+        'HTTP_PROXY',
+        'HTTP_X_APPENGINE_HTTPS',
+        'HTTP_X_APPENGINE_QUEUENAME',
+        'HTTP_X_ORIGINAL_HOST',
+        'HTTP_X_ORIGINAL_SCHEME',
+        'SERVER_NAME',
+        'SERVER_PORT',
+        'SERVER_SOFTWARE',
+        'USER_IS_ADMIN',
+    )),
+    ('app_identity', (
+        'get_service_account_name',
+        'get_application_id',
+        'get_default_version_hostname',
+    )),
+    ('modules', (
+        'get_current_module_name',
+        'get_current_version_name',
+        'get_current_instance_id',
+        'get_modules',
+        'get_versions',
+        'get_default_version',
+        'get_hostname',
+    )),
+    ('namespace_manager', (
+        'get_namespace',
+        'google_apps_namespace',
+    )),
+)
 
 
-# Swap the function that's called if the namespace_manager is disabled.
-if namespace_manager == None:
-  _get_namespace_manager_dict = _get_namespace_manager_dict_v2
-else:
-  _get_namespace_manager_dict = _get_namespace_manager_dict_v1
+def _get_source_module(source):
+  """Return the API module for a source of ENVIRON_KEYS, or None if it is not available."""
+  return {
+      'app_identity': app_identity,
+      'modules': modules,
+      'namespace_manager': namespace_manager,
+  }[source]._lazy_load()
+
+
+class _Lookup(threading.Thread):
+  """Calls one API function on its own thread, keeping its result or exception info."""
+
+  def __init__(self, fn):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self._fn = fn
+    self.start_time = time.time()
+    self.end_time = None
+    self.result = None
+    self.exc_info = None
+
+  def run(self):
+    try:
+      self.result = self._fn()
+    except Exception:
+      self.exc_info = sys.exc_info()
+    finally:
+      self.end_time = time.time()
+
+
+class EnvironDictRpc(object):
+  """Environment lookups started by get_environ_dict_async. Call get_result() for the dictionary."""
+
+  def __init__(self, keys=None, timings=False):
+    keys = None if keys is None else frozenset(keys)
+    self._result = {}
+    self._timings = {} if timings else None
+    # Tuples of (source, key, lookup thread) for the API functions which are still running.
+    self._pending = []
+    for source, source_keys in ENVIRON_KEYS:
+      values = self._result[source] = {}
+      module = None if source == 'os.environ' else _get_source_module(source)
+      for key in source_keys:
+        if keys is not None and key not in keys:
+          continue
+        if source == 'os.environ':
+          start = time.time()
+          values[key] = os.environ.get(key, _UNDEFINED)
+          self._add_timing(source, key, time.time() - start)
+        elif module is not None:
+          # The API functions block on their RPCs, so each one is called on its own thread.
+          lookup = _Lookup(getattr(module, key))
+          lookup.start()
+          self._pending.append((source, key, lookup))
+
+  def _add_timing(self, source, key, seconds):
+    """Record the seconds taken to look up a key."""
+    if self._timings is not None:
+      self._timings['%s.%s' % (source, key)] = seconds
+
+  def get_result(self):
+    """Wait for the lookups to complete, and return the dictionary of environment keys/values.
+
+    With timings, the seconds each lookup took are returned in the 'timings' entry, keyed by "source.key".
+    An exception raised by an API function is raised again here.
+    """
+    pending, self._pending = self._pending, []
+    for source, key, lookup in pending:
+      lookup.join()
+      if lookup.exc_info is not None:
+        raise lookup.exc_info[0], lookup.exc_info[1], lookup.exc_info[2]
+      self._result[source][key] = lookup.result
+      self._add_timing(source, key, lookup.end_time - lookup.start_time)
+    if self._timings is not None:
+      self._result['timings'] = self._timings
+    return self._result
+
+
+def get_environ_dict_async(keys=None, timings=False):
+  """Start looking up environment keys/values concurrently, and return an EnvironDictRpc.
+
+  The API functions block on their RPCs, so each one is called on its own thread.
+  `keys` limits the lookups to the given os.environ keys and API function names.
+  """
+  return EnvironDictRpc(keys, timings)
 
 
-def get_environ_dict():
-  """Return a dictionary of all environment keys/values."""
-  return {
-      'os.environ': _get_os_environ_dict((
-          'AUTH_DOMAIN',
-          'CURRENT_CONFIGURATION_VERSION',
-          'CURRENT_MODULE_ID',
-          'CURRENT_VERSION_ID',
-          'DEFAULT_VERSION_HOSTNAME',
-          'FEDERATED_IDENTITY',
-          'FEDERATED_PROVIDER',
-          'GAE_LOCAL_VM_RUNTIME',
-          'HTTP_HOST',
-          'HTTP_PROXY',
-          'HTTP_X_APPENGINE_HTTPS',
-          'HTTP_X_APPENGINE_QUEUENAME',
-          'HTTP_X_ORIGINAL_HOST',
-          'HTTP_X_ORIGINAL_SCHEME',
-          'SERVER_NAME',
-          'SERVER_PORT',
-          'SERVER_SOFTWARE',
-          'USER_IS_ADMIN',
-      )),
-      'app_identity': _get_app_identity_dict((
-          'get_service_account_name',
-          'get_application_id',
-          'get_default_version_hostname',
-      )),
-      'modules': _get_modules_dict((
-          'get_current_module_name',
-          'get_current_version_name',
-          'get_current_instance_id',
-          'get_modules',
-          'get_versions',
-          'get_default_version',
-          'get_hostname',
-      )),
-      'namespace_manager': _get_namespace_manager_dict((
-          'get_namespace',
-          'google_apps_namespace',
-      )),
-  }
+def get_environ_dict(keys=None, timings=False):
+  """Return a dictionary of all (or the given) environment keys/values."""
+  return get_environ_dict_async(keys, timings).get_result()
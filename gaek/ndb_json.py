@@ -23,7 +23,7 @@ Usage:
 
 Dependencies:
 
-  - dateutil: https://pypi.python.org/pypi/python-dateutil
+  - dateutil: https://pypi.python.org/pypi/python-dateutil (only used with `ndb_lenient_dates=True`)
 """
 
 __author__ = 'Eric Higgins'
@@ -32,46 +32,194 @@ __email__ = 'erichiggins@gmail.com'
 
 
 import base64
+import binascii
+import collections
 import datetime
+import hashlib
+import itertools
 import json
+import re
+import threading
 import time
 import types
+import uuid
 
-import dateutil.parser
 from google.appengine.ext import ndb
 
+from gaek._lazy import is_installed, LazyModule
+
+# Imported on first use, to keep them out of the cold start of instances which don't need them.
+dateutil_parser = LazyModule('dateutil.parser')
+memcache = LazyModule('google.appengine.api.memcache')
+multiprocessing = LazyModule('multiprocessing')
+simplejson = LazyModule('simplejson', optional=True)
+ujson = LazyModule('ujson', optional=True)
+
 
 __all__ = (
     'dump',
+    'dump_lines',
+    'dump_async',
+    'dump_parallel',
     'dumps',
+    'dumps_async',
+    'FragmentCache',
+    'get_json_backend',
+    'import_entities',
+    'load',
+    'load_lines',
     'loads',
     'NdbDecoder',
     'NdbEncoder',
+    'NdbStats',
+    'register_type_encoder',
 )
 
 
 def encode_model(obj):
   """Encode objects like ndb.Model which have a `.to_dict()` method."""
-  obj_dict = obj.to_dict()
+  if isinstance(obj, ndb.Model):
+    return get_model_serializer(type(obj))(obj)
+  return _encode_dict_values(obj.to_dict())
+
+
+def _encode_str_value(val):
+  """Encode a value of unknown type, converting binary strings (blobs) to base64."""
+  if isinstance(val, types.StringType):
+    try:
+      unicode(val)
+    except UnicodeDecodeError:
+      return base64.b64encode(val)
+  return val
+
+
+def _encode_dict_values(obj_dict):
+  """Encode the values of a `.to_dict()` result in place, converting binary strings to base64."""
   for key, val in obj_dict.iteritems():
-    if isinstance(val, types.StringType):
-      try:
-        unicode(val)
-      except UnicodeDecodeError:
-        # Encode binary strings (blobs) to base64.
-        obj_dict[key] = base64.b64encode(val)
+    obj_dict[key] = _encode_str_value(val)
   return obj_dict
 
 
+def _collect_keys(obj, keys, get_serializer=None, futures=None):
+  """Recursively gather the ndb.Key instances referenced by `obj` into the `keys` set.
+
+  Only the properties of Models which are selected by their ModelSerializer, as returned by
+  `get_serializer(model_class)`, are searched. The nested Models of structured properties are
+  encoded whole, so all of their properties are searched. Pending ndb.Futures are gathered into
+  the `futures` set when one is given.
+  """
+  if isinstance(obj, ndb.Key):
+    keys.add(obj)
+  elif isinstance(obj, ndb.Model):
+    serializer = (get_serializer or get_model_serializer)(type(obj))
+    for prop in serializer.iter_properties(obj):
+      try:
+        val = prop._get_value(obj)
+      except ndb.UnprojectedPropertyError:
+        continue
+      _collect_keys(val, keys, None if isinstance(prop, STRUCTURED_PROPERTY_TYPES) else get_serializer, futures)
+  elif isinstance(obj, dict):
+    for val in obj.itervalues():
+      _collect_keys(val, keys, get_serializer, futures)
+  elif isinstance(obj, (list, tuple, set, frozenset)):
+    for val in obj:
+      _collect_keys(val, keys, get_serializer, futures)
+  elif isinstance(obj, ndb.Future):
+    if obj.done():
+      _collect_keys(obj.get_result(), keys, get_serializer, futures)
+    elif futures is not None:
+      futures.add(obj)
+
+
+def _equality_filter_names(node):
+  """Get the names of the properties which the filters of an ndb.Query test for equality."""
+  if isinstance(node, ndb.FilterNode):
+    name, opsymbol, _ = node.__getnewargs__()
+    return set([name]) if opsymbol == '=' else set()
+  names = set()
+  if isinstance(node, (ndb.ConjunctionNode, ndb.DisjunctionNode)):
+    for child in node:
+      names.update(_equality_filter_names(child))
+  return names
+
+
 def encode_generator(obj):
   """Encode generator-like objects, such as ndb.Query."""
   return list(obj)
 
 
+def _pages_by_cursor(query):
+  """True if the pages of an ndb.Query can be fetched with cursors.
+
+  Queries with IN, != or OR filters run as several merged queries, which don't support cursors.
+  """
+  return not isinstance(query.filters, ndb.DisjunctionNode)
+
+
+def _iter_query_pages(query, page_size):
+  """Yield the results of an ndb.Query which can't use cursors, in lists of up to `page_size`,
+  from one iterator which fetches batches of `page_size` results.
+  """
+  iterator = query.iter(batch_size=page_size)
+  more = iterator.has_next_async()
+  while more.get_result():
+    page = [iterator.next()]
+    while len(page) < page_size and iterator.has_next():
+      page.append(iterator.next())
+    # Look for the next result while the current page is encoded and written.
+    more = iterator.has_next_async()
+    yield page
+
+
+@ndb.tasklet
+def _fetch_results_async(obj):
+  """Fetch the results of an ndb.Query or ndb.QueryIterator as a list, yielding to the event loop.
+
+  Other objects are returned as-is.
+  """
+  if isinstance(obj, ndb.Query):
+    obj = yield obj.fetch_async()
+  elif isinstance(obj, ndb.QueryIterator):
+    results = []
+    while (yield obj.has_next_async()):
+      results.append(obj.next())
+    obj = results
+  raise ndb.Return(obj)
+
+
+def _iter_pages(obj, page_size):
+  """Yield the results of an ndb.Query, or the items of an iterable, in lists of up to `page_size`.
+
+  The next page of an ndb.Query is requested before the current one is yielded,
+  so that its datastore RPC runs while the current page is encoded and written.
+  """
+  if isinstance(obj, ndb.Query) and not _pages_by_cursor(obj):
+    for page in _iter_query_pages(obj, page_size):
+      yield page
+  elif isinstance(obj, ndb.Query):
+    future = obj.fetch_page_async(page_size)
+    while future is not None:
+      results, cursor, more = future.get_result()
+      if more and cursor:
+        future = obj.fetch_page_async(page_size, start_cursor=cursor)
+      else:
+        future = None
+      if results:
+        yield results
+  else:
+    iterator = iter(obj)
+    while True:
+      page = list(itertools.islice(iterator, page_size))
+      if not page:
+        return
+      yield page
+
+
 def encode_key_as_entity(obj):
   """Get the Entity from the ndb.Key for further encoding."""
   # NOTE(erichiggins): Potentially poor performance for Models w/ many KeyProperty properties.
   # NOTE(ronufryk): Potentially can cause circular references and "RuntimeError: maximum recursion depth exceeded"
+  # Use NdbEncoder(ndb_keys_batched=True) and/or NdbEncoder(ndb_keys_memo=True) to avoid both.
   return obj.get_async()
 
 
@@ -103,6 +251,36 @@ def encode_datetime(obj):
   return obj.isoformat() + zone
 
 
+def encode_blob(obj):
+  """Encode a binary string (blob) as a base64 string."""
+  return base64.b64encode(obj)
+
+
+# Bytes of a blob encoded per chunk by `iter_base64`, a multiple of 3 so that the chunks join without padding.
+BLOB_CHUNK_SIZE = 3 * 16 * 1024
+
+
+def iter_base64(obj):
+  """Encode a binary string (blob) as base64, yielding it in chunks without copying the blob."""
+  view = memoryview(obj)
+  for start in xrange(0, len(obj), BLOB_CHUNK_SIZE):
+    # b2a_base64 appends a newline to each chunk.
+    yield binascii.b2a_base64(view[start:start + BLOB_CHUNK_SIZE])[:-1]
+
+
+class BlobValue(object):
+  """The value of a BlobProperty, which NdbEncoder writes into its output as base64 in chunks."""
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+
+def encode_blob_value(obj):
+  """Encode a BlobValue as a base64 string."""
+  return encode_blob(obj.value)
+
+
 def encode_complex(obj):
   """Convert a complex number object into a list containing the real and imaginary values."""
   return [obj.real, obj.imag]
@@ -128,10 +306,694 @@ NDB_TYPE_ENCODING = {
   time.struct_time: encode_generator,
   types.ComplexType: encode_complex,
   ndb.model._BaseValue: encode_basevalue,
+  BlobValue: encode_blob_value,
+}
+
+
+def _sort_types(type_encoding):
+  """Sort the types so any iteration is in a deterministic order."""
+  return sorted(type_encoding.keys(), key=lambda t: t.__name__)
+
+
+NDB_TYPES = _sort_types(NDB_TYPE_ENCODING)
+
+# Names of the table of Keys and of the data in documents written with `ndb_keys_as_interned`,
+# and of the references to the Keys of the table.
+KEY_TABLE = '__ndb_keys__'
+KEY_DATA = '__ndb_data__'
+KEY_REF = '__ndb_key__'
+
+# Types which `dump(..., ndb_stream=True)` writes one page at a time.
+STREAM_TYPES = (ndb.Query, ndb.QueryIterator, collections.Iterator, list, tuple)
+
+# Default number of results fetched per page when streaming.
+STREAM_PAGE_SIZE = 100
+
+# Number of keys fetched per RPC by dump_parallel, to find the cursors of its pages.
+PARALLEL_KEYS_BATCH_SIZE = 1000
+
+# Default number of characters read at a time when decoding a stream.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def register_type_encoder(obj_type, fn):
+  """Register an encoder function for `obj_type` and its subclasses, used by every new NdbEncoder."""
+  NDB_TYPE_ENCODING[obj_type] = fn
+  NDB_TYPES[:] = _sort_types(NDB_TYPE_ENCODING)
+
+
+# Encoders for the values of declared Model properties, by exact property type. Properties
+# mapped to None are emitted as-is and left to NdbEncoder (e.g. Keys, which depend on the Key mode).
+# Subclasses are not matched, since they often change the type of their values (JsonProperty,
+# PickleProperty, ...), and are encoded like `.to_dict()` values instead.
+PROPERTY_TYPE_ENCODING = {
+  ndb.BlobProperty: encode_blob,
+  ndb.BooleanProperty: None,
+  ndb.DateProperty: encode_datetime,
+  ndb.DateTimeProperty: encode_datetime,
+  ndb.FloatProperty: None,
+  ndb.IntegerProperty: None,
+  ndb.KeyProperty: None,
+  ndb.StringProperty: None,
+  ndb.TextProperty: None,
+}
+
+STRUCTURED_PROPERTY_TYPES = (ndb.StructuredProperty, ndb.LocalStructuredProperty)
+
+
+class ModelSerializer(object):
+  """Encodes the instances of one ndb.Model class, using its declared properties.
+
+  When `include` or `exclude` are given (as frozensets of property names), only the properties
+  named in `include` and not in `exclude` are read and encoded.
+
+  BlobProperty values are encoded according to `blobs`: 'base64', 'omit' to leave them out,
+  'defer' to wrap them in a BlobValue from `defer_blob_size` bytes, or a function called with (entity, name, value).
+
+  Use `get_model_serializer` to get the cached serializer of a Model class.
+  """
+
+  # Encoders for the values of declared properties, by exact property type.
+  property_encoding = PROPERTY_TYPE_ENCODING
+
+  # Size from which blobs are deferred when `blobs` is 'defer'. Smaller blobs are encoded as base64 at once.
+  defer_blob_size = BLOB_CHUNK_SIZE
+
+  def __init__(self, model_class, include=None, exclude=None, blobs='base64'):
+    self._properties = model_class._properties
+    self._include = include
+    self._exclude = exclude
+    self._blobs = blobs
+    self._is_expando = issubclass(model_class, ndb.Expando)
+    # Classes which customize their dict representation are encoded through `.to_dict()`.
+    self._uses_to_dict = (
+        model_class.to_dict.im_func is not ndb.Model.to_dict.im_func
+        or model_class._to_dict.im_func is not ndb.Model._to_dict.im_func)
+    # The selected declared properties.
+    self._selected = []
+    # Tuples of (name, property, encoder) for properties with a known value type.
+    self._typed = []
+    # Tuples of (name, property) for all other properties.
+    self._generic = []
+    # Tuples of (name, property) for BlobProperty properties, when they are not encoded as base64.
+    self._blob_properties = []
+    for prop in self._properties.itervalues():
+      prop_type = type(prop)
+      if not self._is_selected(prop._code_name) or (prop_type is ndb.BlobProperty and blobs == 'omit'):
+        continue
+      self._selected.append(prop)
+      if prop_type is ndb.BlobProperty and blobs != 'base64':
+        self._blob_properties.append((prop._code_name, prop))
+      elif prop_type in STRUCTURED_PROPERTY_TYPES:
+        self._typed.append((prop._code_name, prop, self._encode_structured))
+      elif prop_type in self.property_encoding:
+        self._typed.append((prop._code_name, prop, self.property_encoding[prop_type]))
+      else:
+        self._generic.append((prop._code_name, prop))
+
+  def __call__(self, entity):
+    """Encode an entity into a dictionary, like `encode_model`."""
+    if self._uses_to_dict:
+      values = entity.to_dict()
+      if self._include is not None or self._exclude is not None:
+        values = {k: v for k, v in values.iteritems() if self._is_selected(k)}
+      return _encode_dict_values(values)
+    values = {}
+    for name, prop, fn in self._typed:
+      try:
+        val = prop._get_value(entity)
+      except ndb.UnprojectedPropertyError:
+        continue
+      if fn is not None and val is not None:
+        val = [fn(v) for v in val] if prop._repeated else fn(val)
+      values[name] = val
+    for name, prop in self._blob_properties:
+      try:
+        val = prop._get_value(entity)
+      except ndb.UnprojectedPropertyError:
+        continue
+      if val is not None:
+        val = ([self._encode_blob(entity, name, v) for v in val] if prop._repeated
+               else self._encode_blob(entity, name, val))
+      values[name] = val
+    for name, prop in self._generic:
+      self._encode_generic(entity, name, prop, values)
+    if entity._properties is not self._properties:
+      # Expando instances carry their dynamic properties in their own dictionary, along with the declared ones.
+      for prop in entity._properties.itervalues():
+        name = prop._code_name
+        if name not in values and prop._name not in self._properties and self._is_selected(name):
+          self._encode_generic(entity, name, prop, values)
+    return values
+
+  def _is_selected(self, name):
+    """True if the property `name` is to be encoded."""
+    return ((self._include is None or name in self._include)
+            and (self._exclude is None or name not in self._exclude))
+
+  def iter_properties(self, entity):
+    """Yield the selected properties of an entity, including the dynamic properties of an Expando."""
+    if entity._properties is self._properties:
+      for prop in self._selected:
+        yield prop
+    else:
+      for prop in entity._properties.itervalues():
+        if self._is_selected(prop._code_name):
+          yield prop
+
+  def get_projection(self):
+    """Get the stored names of the selected properties, as a query projection.
+
+    Returns None when nothing is deselected, or when the selected properties can't all be
+    projected: projections only return single, indexed values, and lose the dynamic properties
+    of an Expando and the values read by a custom `.to_dict()`.
+    """
+    if (self._include is None and self._exclude is None) or not self._selected:
+      return None
+    if self._is_expando or self._uses_to_dict:
+      return None
+    for prop in self._selected:
+      if (not prop._indexed or prop._repeated or isinstance(prop, STRUCTURED_PROPERTY_TYPES)
+          or isinstance(prop, ndb.ComputedProperty)):
+        return None
+    return tuple(prop._name for prop in self._selected)
+
+  def _encode_generic(self, entity, name, prop, values):
+    """Encode a property of unknown value type the way `.to_dict()` would."""
+    try:
+      values[name] = _encode_str_value(prop._get_for_dict(entity))
+    except ndb.UnprojectedPropertyError:
+      pass
+
+  def _encode_blob(self, entity, name, val):
+    """Encode a blob which is not encoded by the property encoders."""
+    if self._blobs == 'defer':
+      if len(val) < self.defer_blob_size:
+        return encode_blob(val)
+      return BlobValue(val)
+    return self._blobs(entity, name, val)
+
+  def _encode_structured(self, obj):
+    """Encode the Model instance held by a StructuredProperty or LocalStructuredProperty."""
+    return get_model_serializer(type(obj), blobs=self._blobs, serializer_class=type(self))(obj)
+
+
+_model_serializers = {}
+
+
+def get_model_serializer(model_class, include=None, exclude=None, blobs='base64', serializer_class=ModelSerializer):
+  """Get the ModelSerializer (or `serializer_class`) for an ndb.Model class and options, building it on first use."""
+  cache_key = (serializer_class, model_class, include, exclude, blobs)
+  try:
+    return _model_serializers[cache_key]
+  except KeyError:
+    serializer = _model_serializers[cache_key] = serializer_class(model_class, include, exclude, blobs)
+    return serializer
+
+
+def _check_field_selection(name, fields):
+  """Validate the value of the `ndb_include` or `ndb_exclude` argument."""
+  if fields is None:
+    return None
+  if isinstance(fields, basestring) or not isinstance(fields, (dict, list, tuple, set, frozenset)):
+    raise ValueError('Argument %s must be a list of property names, or a dict of them by kind' % name)
+  if isinstance(fields, dict):
+    return {kind: frozenset(names) for kind, names in fields.iteritems()}
+  return frozenset(fields)
+
+
+def _select_fields(fields, kind):
+  """Get the property names selected for `kind` by a validated `ndb_include` or `ndb_exclude`."""
+  if isinstance(fields, dict):
+    return fields.get(kind)
+  return fields
+
+
+# Matches the ISO 8601 date and datetime strings produced by `encode_datetime`.
+ISO_DATETIME_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)'
+    r'(?:T(\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?(Z|[+-]\d\d:\d\d)?)?\Z')
+
+
+class FixedOffset(datetime.tzinfo):
+  """A timezone with a fixed offset from UTC, in minutes."""
+
+  def __init__(self, minutes):
+    self._minutes = minutes
+    self._offset = datetime.timedelta(minutes=minutes)
+
+  def __getinitargs__(self):
+    return (self._minutes,)
+
+  def __repr__(self):
+    return 'FixedOffset(%d)' % self._minutes
+
+  def utcoffset(self, dt):
+    return self._offset
+
+  def dst(self, dt):
+    return datetime.timedelta(0)
+
+  def tzname(self, dt):
+    return None
+
+
+def decode_datetime(val):
+  """Decode an ISO 8601 string, as produced by `encode_datetime`, into a datetime object.
+
+  Returns None if the string is not in one of those formats. UTC datetimes are returned offset-naive.
+  """
+  match = ISO_DATETIME_RE.match(val)
+  if match is None:
+    return None
+  year, month, day, hour, minute, second, fraction, zone = match.groups()
+  try:
+    dt = datetime.datetime(
+        int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+        int(fraction.ljust(6, '0')) if fraction else 0)
+  except ValueError:
+    return None
+  if zone and zone != 'Z':
+    minutes = int(zone[1:3]) * 60 + int(zone[4:6])
+    if minutes:
+      dt = dt.replace(tzinfo=FixedOffset(-minutes if zone[0] == '-' else minutes))
+  return dt
+
+
+def decode_blob(val):
+  """Decode a base64 string, as produced by `encode_blob`, into a binary string.
+
+  Long strings are decoded in chunks, so that a unicode string is not copied whole into an ASCII string first.
+  """
+  size = BLOB_CHUNK_SIZE // 3 * 4
+  if len(val) > size and not len(val) % 4:
+    try:
+      return ''.join(binascii.a2b_base64(val[start:start + size]) for start in xrange(0, len(val), size))
+    except binascii.Error:
+      # Chunks are misaligned when the string contains whitespace.
+      pass
+  return base64.b64decode(val)
+
+
+def decode_datetime_property(val):
+  """Decode a string into an offset-naive UTC datetime, for a DateTimeProperty."""
+  dt = decode_datetime(val)
+  if dt is None:
+    raise ValueError('Invalid datetime string: %r' % val)
+  if dt.tzinfo is not None:
+    dt = dt.replace(tzinfo=None) - dt.utcoffset()
+  return dt
+
+
+def decode_date_property(val):
+  """Decode a string into a date, for a DateProperty."""
+  return decode_datetime_property(val).date()
+
+
+def decode_key(val):
+  """Decode an ndb.Key from its URL-safe string or its list of (kind, id) pairs. Keys are returned as-is."""
+  if isinstance(val, ndb.Key):
+    return val
+  if isinstance(val, basestring):
+    return ndb.Key(urlsafe=val)
+  return ndb.Key(pairs=[tuple(pair) for pair in val])
+
+
+def decode_key_table(table):
+  """Decode the table of Keys written with `ndb_keys_as_interned` into a list of ndb.Keys, by index.
+
+  The table holds the list of kinds, and the path of each Key as `[kind, id]` or `[parent, kind, id]`,
+  where `kind` is an index in the list of kinds and `parent` the index of the parent Key.
+  """
+  kinds = table['kinds']
+  keys = []
+  for path in table['paths']:
+    if len(path) == 2:
+      pairs = ((kinds[path[0]], path[1]),)
+    else:
+      pairs = keys[path[0]].pairs() + ((kinds[path[1]], path[2]),)
+    keys.append(ndb.Key(pairs=pairs))
+  return keys
+
+
+def _replace_key_refs(obj, keys):
+  """Replace the `{"__ndb_key__": index}` references in a decoded value with the ndb.Keys they refer to."""
+  if isinstance(obj, dict):
+    if len(obj) == 1 and KEY_REF in obj:
+      return keys[obj[KEY_REF]]
+    return {k: _replace_key_refs(v, keys) for k, v in obj.iteritems()}
+  if isinstance(obj, list):
+    return [_replace_key_refs(v, keys) for v in obj]
+  return obj
+
+
+def decode_interned_keys(obj):
+  """Unwrap a document written with `ndb_keys_as_interned`, rebuilding its Keys. Other values are returned as-is."""
+  if isinstance(obj, dict) and len(obj) == 2 and KEY_TABLE in obj and KEY_DATA in obj:
+    return _replace_key_refs(obj[KEY_DATA], decode_key_table(obj[KEY_TABLE]))
+  return obj
+
+
+# Decoders for the values of declared Model properties, by exact property type. Properties
+# of other types are set from their decoded JSON value as-is.
+PROPERTY_TYPE_DECODING = {
+  ndb.BlobProperty: decode_blob,
+  ndb.DateProperty: decode_date_property,
+  ndb.DateTimeProperty: decode_datetime_property,
+  ndb.KeyProperty: decode_key,
+}
+
+
+class ModelDeserializer(object):
+  """Builds instances of one ndb.Model class from decoded JSON objects, using its declared properties.
+
+  BlobProperty values are decoded from base64, or by calling `blobs` with their decoded JSON value.
+
+  Use `get_model_deserializer` to get the cached deserializer of a Model class.
+  """
+
+  # Decoders for the values of declared properties, by exact property type.
+  property_decoding = PROPERTY_TYPE_DECODING
+
+  def __init__(self, model_class, blobs='base64'):
+    self._model_class = model_class
+    self._is_expando = issubclass(model_class, ndb.Expando)
+    # Maps property names to a tuple of (property, decoder).
+    self._fields = {}
+    # Names of ComputedProperty properties, whose encoded values are left out of the entities.
+    self._computed = set()
+    for prop in model_class._properties.itervalues():
+      prop_type = type(prop)
+      if prop_type is ndb.ComputedProperty:
+        self._computed.add(prop._code_name)
+        continue
+      if prop_type in STRUCTURED_PROPERTY_TYPES:
+        fn = get_model_deserializer(prop._modelclass, blobs, type(self))
+      elif prop_type is ndb.BlobProperty and blobs != 'base64':
+        fn = blobs
+      else:
+        fn = self.property_decoding.get(prop_type)
+      self._fields[prop._code_name] = (prop, fn)
+
+  def __call__(self, obj):
+    """Build an entity from a dictionary, such as the output of `encode_model`."""
+    values = {}
+    for name, val in obj.iteritems():
+      try:
+        prop, fn = self._fields[name]
+      except KeyError:
+        if self._is_expando and name not in self._computed:
+          values[name] = val
+        continue
+      if type(prop) is ndb.KeyProperty and (isinstance(val, dict) or (prop._repeated and val and isinstance(val[0], dict))):
+        # Keys which were encoded as entities can't be rebuilt.
+        continue
+      if fn is not None and val is not None:
+        val = [fn(v) for v in val] if prop._repeated else fn(val)
+      values[name] = val
+    entity = self._model_class()
+    entity.populate(**values)
+    return entity
+
+
+_model_deserializers = {}
+
+
+def get_model_deserializer(model_class, blobs='base64', deserializer_class=ModelDeserializer):
+  """Get the ModelDeserializer (or `deserializer_class`) for an ndb.Model class and blob decoding,
+  building it on first use.
+  """
+  cache_key = (deserializer_class, model_class, blobs)
+  try:
+    return _model_deserializers[cache_key]
+  except KeyError:
+    deserializer = _model_deserializers[cache_key] = deserializer_class(model_class, blobs)
+    return deserializer
+
+
+JsonBackend = collections.namedtuple('JsonBackend', ('name', 'dumps', 'loads'))
+
+
+def _json_dumps(obj, encoder):
+  """Serialize JSON-compatible Python types with the standard json module."""
+  return json.dumps(
+      obj, skipkeys=encoder.skipkeys, ensure_ascii=encoder.ensure_ascii, check_circular=False,
+      allow_nan=encoder.allow_nan, indent=encoder.indent,
+      separators=(encoder.item_separator, encoder.key_separator), sort_keys=encoder.sort_keys)
+
+
+def _simplejson_dumps(obj, encoder):
+  """Serialize JSON-compatible Python types with simplejson's C speedups."""
+  return simplejson.dumps(
+      obj, skipkeys=encoder.skipkeys, ensure_ascii=encoder.ensure_ascii, check_circular=False,
+      allow_nan=encoder.allow_nan, indent=encoder.indent,
+      separators=(encoder.item_separator, encoder.key_separator), sort_keys=encoder.sort_keys)
+
+
+def _simplejson_loads(s, **kwargs):
+  """Deserialize JSON with simplejson."""
+  return simplejson.loads(s, **kwargs)
+
+
+def _ujson_dumps(obj, encoder):
+  """Serialize JSON-compatible Python types with ujson. Separators are always compact."""
+  return ujson.dumps(
+      obj, ensure_ascii=encoder.ensure_ascii, sort_keys=encoder.sort_keys,
+      indent=encoder.indent or 0, escape_forward_slashes=False)
+
+
+def _ujson_loads(s, **kwargs):
+  """Deserialize JSON with ujson."""
+  return ujson.loads(s, **kwargs)
+
+
+# Installed JSON backends, by name.
+JSON_BACKENDS = {
+  'json': JsonBackend('json', _json_dumps, json.loads),
 }
+if is_installed('simplejson'):
+  JSON_BACKENDS['simplejson'] = JsonBackend('simplejson', _simplejson_dumps, _simplejson_loads)
+if is_installed('ujson'):
+  JSON_BACKENDS['ujson'] = JsonBackend('ujson', _ujson_dumps, _ujson_loads)
+
+# Backends picked by `get_json_backend('auto')`, fastest first.
+JSON_BACKEND_PREFERENCE = ('ujson', 'simplejson', 'json')
 
-# Sort the types so any iteration is in a deterministic order
-NDB_TYPES = sorted(NDB_TYPE_ENCODING.keys(), key=lambda t: t.__name__)
+
+def get_json_backend(name):
+  """Get an installed JsonBackend by name, or the fastest installed one for 'auto'."""
+  if name == 'auto':
+    name = next(n for n in JSON_BACKEND_PREFERENCE if n in JSON_BACKENDS)
+  try:
+    return JSON_BACKENDS[name]
+  except KeyError:
+    raise ValueError('JSON backend %r is not installed' % name)
+
+
+# Types which are already JSON-compatible, and converted as-is.
+_PRIMITIVE_TYPES = frozenset((str, unicode, int, long, float, bool, types.NoneType))
+
+
+class FragmentCache(object):
+  """Cache of the JSON encoding of entities (fragments), kept in a local LRU and in memcache.
+
+  Pass it to NdbEncoder, `dumps` or `dump` as `ndb_cache`. Fragments are stored by entity Key along with
+  the version of the entity they were encoded from, and only used for an entity of the same version.
+  The version is the value of the `version` property (such as an `auto_now` DateTimeProperty), or the
+  result of calling `version(entity)`. It must be cheaper to get than encoding the entity again.
+
+  Call `invalidate(key)` from the `_post_put_hook` and `_post_delete_hook` of Models to drop their
+  fragments as soon as they change.
+  """
+
+  def __init__(self, version, size=1000, use_memcache=True, ttl=3600, namespace='gaek.ndb_json'):
+    if not (isinstance(version, basestring) or callable(version)):
+      raise ValueError('Argument version must be a property name or a function')
+    self._size = size
+    self._version = version
+    self._use_memcache = use_memcache
+    self._ttl = ttl
+    self._namespace = namespace
+    self._lock = threading.Lock()
+    # Tuples of (version, fragment) by cache key, least recently used first.
+    self._local = collections.OrderedDict()
+    # Tuples of (version, fragment) to be written to memcache by flush(), by cache key.
+    self._pending = {}
+    # Fingerprints of the encoder options this cache was used with, to invalidate all the fragments of a Key.
+    self._fingerprints = set()
+
+  def make_key(self, fingerprint, key):
+    """Get the cache key of the fragment of an entity Key, encoded with the options of `fingerprint`."""
+    self._fingerprints.add(fingerprint)
+    return '%s:%s' % (fingerprint, key.urlsafe())
+
+  def get_version(self, entity):
+    """Get the version stamp of an entity."""
+    if callable(self._version):
+      return self._version(entity)
+    return getattr(entity, self._version)
+
+  def _store_local(self, cache_key, entry):
+    """Store an entry in the local LRU, evicting the least recently used ones beyond its size."""
+    with self._lock:
+      self._local.pop(cache_key, None)
+      self._local[cache_key] = entry
+      while len(self._local) > self._size:
+        self._local.popitem(last=False)
+
+  def get(self, cache_key, version):
+    """Get the fragment stored for a cache key and version, or None. Only the local LRU is searched."""
+    with self._lock:
+      entry = self._local.pop(cache_key, None)
+      if entry is None:
+        return None
+      self._local[cache_key] = entry
+    return entry[1] if entry[0] == version else None
+
+  def set(self, cache_key, version, fragment):
+    """Store a fragment, which is written to memcache by the next flush()."""
+    entry = (version, fragment)
+    self._store_local(cache_key, entry)
+    if self._use_memcache:
+      self._pending[cache_key] = entry
+
+  def prefetch(self, cache_keys):
+    """Load the fragments of the given cache keys from memcache into the local LRU, with one RPC."""
+    with self._lock:
+      missing = [cache_key for cache_key in cache_keys if cache_key not in self._local]
+    if self._use_memcache and missing:
+      for cache_key, entry in memcache.get_multi(missing, namespace=self._namespace).iteritems():
+        self._store_local(cache_key, entry)
+
+  def flush(self):
+    """Write the fragments stored since the last flush to memcache, with one RPC."""
+    pending, self._pending = self._pending, {}
+    if pending:
+      memcache.set_multi(pending, time=self._ttl, namespace=self._namespace)
+
+  def invalidate(self, key):
+    """Drop the fragments of an entity Key, locally and from memcache."""
+    cache_keys = [self.make_key(fingerprint, key) for fingerprint in list(self._fingerprints)]
+    with self._lock:
+      for cache_key in cache_keys:
+        self._local.pop(cache_key, None)
+        self._pending.pop(cache_key, None)
+    if self._use_memcache and cache_keys:
+      memcache.delete_multi(cache_keys, namespace=self._namespace)
+
+  def clear(self):
+    """Drop all the local fragments. Fragments in memcache expire after `ttl` seconds."""
+    with self._lock:
+      self._local.clear()
+      self._pending.clear()
+
+
+def _fields_repr(fields):
+  """Get a deterministic representation of a validated `ndb_include` or `ndb_exclude` argument."""
+  if isinstance(fields, dict):
+    return sorted((kind, sorted(names)) for kind, names in fields.iteritems())
+  return None if fields is None else sorted(fields)
+
+
+class NdbStats(object):
+  """Counters of the work done by the NdbEncoders and NdbDecoders it is passed to as `ndb_stats`.
+
+  Used as a context manager, it also applies to the encoders and decoders created in the `with` block
+  on the same thread, and calls `callback(stats)` at the end of the block, e.g. to log `stats.as_dict()`.
+  """
+
+  def __init__(self, callback=None):
+    self.callback = callback
+    # Number of objects converted by each encoder or decoder function, by type name.
+    self.counts = collections.Counter()
+    # Seconds spent in each encoder or decoder function, by function name.
+    self.times = collections.Counter()
+    # Datastore RPCs issued to fetch the entities of Keys.
+    self.rpcs = 0
+    # Seconds spent blocked on Futures: entities, Future values and batches of Keys.
+    self.wait_time = 0.0
+    # Characters of JSON written by encoders, and read by decoders.
+    self.bytes_encoded = 0
+    self.bytes_decoded = 0
+
+  def wrap(self, fn, name=None, rpc=False, wait=False):
+    """Wrap a function of one argument to count its calls by argument type and time them.
+
+    With `rpc`, each call counts as a datastore RPC. With `wait`, its time counts as blocking.
+    """
+    name = name or fn.__name__
+    counts = self.counts
+    times = self.times
+    clock = time.time
+
+    def timed(obj):
+      start = clock()
+      try:
+        return fn(obj)
+      finally:
+        elapsed = clock() - start
+        times[name] += elapsed
+        counts[type(obj).__name__] += 1
+        if rpc:
+          self.rpcs += 1
+        if wait:
+          self.wait_time += elapsed
+    timed.__name__ = name
+    return timed
+
+  def time_iter(self, name, iterator):
+    """Yield the items of an iterator, adding the time taken to produce them to `name`."""
+    clock = time.time
+    iterator = iter(iterator)
+    while True:
+      start = clock()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        self.times[name] += clock() - start
+      yield item
+
+  def count_bytes(self, chunks):
+    """Yield encoded chunks, counting their characters."""
+    for chunk in chunks:
+      self.bytes_encoded += len(chunk)
+      yield chunk
+
+  def as_dict(self):
+    """Get the counters as a dictionary, e.g. for logging."""
+    return {
+        'counts': dict(self.counts),
+        'times': dict(self.times),
+        'rpcs': self.rpcs,
+        'wait_time': self.wait_time,
+        'bytes_encoded': self.bytes_encoded,
+        'bytes_decoded': self.bytes_decoded,
+    }
+
+  def __enter__(self):
+    _active_stats.stack = getattr(_active_stats, 'stack', ()) + (self,)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    _active_stats.stack = _active_stats.stack[:-1]
+    if self.callback is not None:
+      self.callback(self)
+
+
+# The NdbStats of the `with` blocks of each thread, innermost last.
+_active_stats = threading.local()
+
+
+def _get_stats(kwargs):
+  """Pop the `ndb_stats` argument, defaulting to the NdbStats of the innermost `with` block of this thread."""
+  stats = kwargs.pop('ndb_stats', None)
+  if stats is None:
+    stack = getattr(_active_stats, 'stack', None)
+    if stack:
+      stats = stack[-1]
+  return stats
 
 
 class NdbDecoder(json.JSONDecoder):
@@ -139,7 +1001,20 @@ class NdbDecoder(json.JSONDecoder):
 
   def __init__(self, **kwargs):
     """Override the default __init__ in order to specify our own parameters."""
-    json.JSONDecoder.__init__(self, object_hook=self.object_hook_handler, **kwargs)
+    self._lenient_dates = kwargs.pop('ndb_lenient_dates', False)
+    self._model = kwargs.pop('ndb_model', None)
+    self._blobs = kwargs.pop('ndb_blobs', 'base64')
+    if self._blobs != 'base64' and not callable(self._blobs):
+      raise ValueError("Argument ndb_blobs must be 'base64' or a function")
+    backend = kwargs.pop('ndb_backend', None)
+    self._backend = None if backend is None else get_json_backend(backend)
+    self._stats = _get_stats(kwargs)
+    if self._stats is not None:
+      for name in ('decode', 'decode_date', 'decode_date_lenient', 'decode_model', 'object_hook_handler'):
+        setattr(self, name, self._stats.wrap(getattr(self, name), name))
+    # With a Model, values are decoded from its declared properties rather than guessed.
+    object_hook = self.object_hook_handler if self._model is None else None
+    json.JSONDecoder.__init__(self, object_hook=object_hook, **kwargs)
 
   def object_hook_handler(self, val):
     """Handles decoding of nested date strings."""
@@ -147,9 +1022,19 @@ class NdbDecoder(json.JSONDecoder):
 
   def decode_date(self, val):
     """Tries to decode strings that look like dates into datetime objects."""
-    if isinstance(val, basestring) and val.count('-') == 2 and len(val) > 9:
+    if isinstance(val, basestring):
+      dt = decode_datetime(val)
+      if dt is not None:
+        return dt
+      if self._lenient_dates:
+        return self.decode_date_lenient(val)
+    return val
+
+  def decode_date_lenient(self, val):
+    """Tries to decode strings in any format that dateutil recognizes into datetime objects."""
+    if val.count('-') == 2 and len(val) > 9:
       try:
-        dt = dateutil.parser.parse(val)
+        dt = dateutil_parser.parse(val)
         # Check for UTC.
         if val.endswith(('+00:00', '-00:00', 'Z')):
           # Then remove tzinfo for gae, which is offset-naive.
@@ -159,76 +1044,1029 @@ class NdbDecoder(json.JSONDecoder):
         pass
     return val
 
+  def decode_model(self, obj):
+    """Build an entity of the decoder's Model from a decoded object, or a list of them from an array."""
+    deserializer = get_model_deserializer(self._model, self._blobs)
+    if isinstance(obj, list):
+      return [deserializer(val) for val in obj]
+    return deserializer(obj)
+
+  def apply_object_hook(self, obj):
+    """Decode nested date strings in a value parsed by a JSON backend, like `object_hook_handler`."""
+    if isinstance(obj, dict):
+      return self.object_hook_handler({k: self.apply_object_hook(v) for k, v in obj.iteritems()})
+    if isinstance(obj, list):
+      return [self.apply_object_hook(v) for v in obj]
+    return obj
+
   def decode(self, val):
     """Override of the default decode method that also uses decode_date."""
+    if self._stats is not None:
+      self._stats.bytes_decoded += len(val)
+    if self._model is not None:
+      if self._backend is not None:
+        return self.decode_model(decode_interned_keys(self._backend.loads(val)))
+      return self.decode_model(decode_interned_keys(json.JSONDecoder.decode(self, val)))
     # First try the date decoder.
     new_val = self.decode_date(val)
     if val != new_val:
       return new_val
+    if self._backend is not None:
+      return decode_interned_keys(self.apply_object_hook(self._backend.loads(val)))
     # Fall back to the default decoder.
-    return json.JSONDecoder.decode(self, val)
+    return decode_interned_keys(json.JSONDecoder.decode(self, val))
+
+  def iterdecode(self, fp, chunk_size=STREAM_CHUNK_SIZE):
+    """Parse a JSON array from a file-like object, yielding its decoded items one at a time.
+
+    The input is read `chunk_size` characters at a time, and only the items of one chunk are held in
+    memory. Dates are decoded, and items are built into entities with `ndb_model`, as by `decode`.
+    """
+    buf = ''
+    pos = 0
+    eof = False
+    # What comes next: the opening bracket, the first item, a separator or an item after a separator.
+    state = 'start'
+    while True:
+      pos = json.decoder.WHITESPACE.match(buf, pos).end()
+      if pos < len(buf):
+        char = buf[pos]
+        if state == 'start':
+          if char != '[':
+            raise ValueError('Expecting a JSON array')
+          pos += 1
+          state = 'first'
+          continue
+        if char == ']' and state != 'item':
+          return
+        if state == 'separator':
+          if char != ',':
+            raise ValueError('Expecting , delimiter: char %d' % pos)
+          pos += 1
+          state = 'item'
+          continue
+        try:
+          obj, end = self.raw_decode(buf, pos)
+        except ValueError:
+          if eof:
+            raise
+        else:
+          # A value which ends with the buffer, such as a number, may continue in the next chunk.
+          if end < len(buf) or eof:
+            pos = end
+            state = 'separator'
+            yield self.decode_model(obj) if self._model is not None else obj
+            continue
+      elif eof:
+        raise ValueError('Unterminated JSON array')
+      # Read at least as much as is buffered, so that a large item is not parsed again for every chunk.
+      chunk = fp.read(max(chunk_size, len(buf) - pos))
+      if self._stats is not None:
+        self._stats.bytes_decoded += len(chunk)
+      buf = buf[pos:] + chunk
+      pos = 0
+      eof = not chunk
 
 
 class NdbEncoder(json.JSONEncoder):
   """Extend the JSON encoder to add support for NDB Models."""
 
+  # Builds the serializers of the Model classes encoded, see `get_model_serializer`.
+  model_serializer_class = ModelSerializer
 
   def __init__(self, **kwargs):
     self._ndb_type_encoding = NDB_TYPE_ENCODING.copy()
 
+    self._include = _check_field_selection('ndb_include', kwargs.pop('ndb_include', None))
+    self._exclude = _check_field_selection('ndb_exclude', kwargs.pop('ndb_exclude', None))
+    self._project_queries = kwargs.pop('ndb_project_query', False)
+    if self._project_queries and self._include is None and self._exclude is None:
+      raise ValueError('Argument ndb_project_query can only be used with ndb_include or ndb_exclude')
+    blobs = kwargs.pop('ndb_blobs', 'base64')
+    if blobs not in ('base64', 'omit') and not callable(blobs):
+      raise ValueError("Argument ndb_blobs must be 'base64', 'omit' or a function")
+    # Blobs of at least BLOB_CHUNK_SIZE bytes are written by _splice as base64, straight into the output.
+    self._blobs = 'defer' if blobs == 'base64' else blobs
+    # Prefix of the strings which stand in for blobs and cached fragments in the output of the JSON encoder.
+    self._splice_token = 'gaek-splice-%s-' % uuid.uuid4().hex
+    self._splice_ids = itertools.count()
+    # Tuples of (quoted, chunks) to be written by _splice, keyed by the string standing in for them.
+    self._splices = {}
+    # ModelSerializers for the selected properties, keyed by Model class.
+    self._serializers = {}
+    # Models are encoded with the options of this encoder, unless their encoder was replaced.
+    if self._ndb_type_encoding[ndb.MetaModel] is encode_model:
+      self._ndb_type_encoding[ndb.MetaModel] = self._encode_model
+    self._ndb_type_encoding[BlobValue] = self._encode_blob_value
+
     keys_as_entities = kwargs.pop('ndb_keys_as_entities', False)
     keys_as_pairs = kwargs.pop('ndb_keys_as_pairs', False)
     keys_as_urlsafe = kwargs.pop('ndb_keys_as_urlsafe', False)
-
-    # Validate that only one of three flags is True
-    if ((keys_as_entities and keys_as_pairs)
-        or (keys_as_entities and keys_as_urlsafe)
-        or (keys_as_pairs and keys_as_urlsafe)):
-      raise ValueError('Only one of arguments ndb_keys_as_entities, ndb_keys_as_pairs, ndb_keys_as_urlsafe can be True')
+    keys_as_interned = kwargs.pop('ndb_keys_as_interned', False)
+    keys_batched = kwargs.pop('ndb_keys_batched', False)
+    keys_memo = kwargs.pop('ndb_keys_memo', False)
+    self._keys_max_depth = kwargs.pop('ndb_keys_max_depth', None)
+    self._keys_fallback = kwargs.pop('ndb_keys_fallback', encode_key_as_urlsafe)
+    self._key_window = kwargs.pop('ndb_key_window', None)
+
+    # Validate that only one of the flags is True
+    if sum(map(bool, (keys_as_entities, keys_as_pairs, keys_as_urlsafe, keys_as_interned))) > 1:
+      raise ValueError('Only one of arguments ndb_keys_as_entities, ndb_keys_as_pairs, ndb_keys_as_urlsafe, '
+                       'ndb_keys_as_interned can be True')
+    keys_as_values = keys_as_pairs or keys_as_urlsafe or keys_as_interned
+    if keys_batched and keys_as_values:
+      raise ValueError('Argument ndb_keys_batched can only be used when encoding Keys as entities')
+    if keys_memo and keys_as_values:
+      raise ValueError('Argument ndb_keys_memo can only be used when encoding Keys as entities')
+    if self._key_window and (keys_as_values or keys_batched or keys_memo):
+      raise ValueError('Argument ndb_key_window can only be used when encoding Keys as entities, '
+                       'without ndb_keys_batched or ndb_keys_memo')
+
+    self._keys_batched = keys_batched
+    # Entities fetched during one encoding call, keyed by ndb.Key. None unless batching or memoizing.
+    self._entities = None
+    # Encoded entities from one encoding call, keyed by ndb.Key. None unless memoizing.
+    self._encoded = None
+    # Futures of the entities fetched ahead of the streamed values, keyed by ndb.Key, and the
+    # number of values in the window which reference each Key.
+    self._key_futures = {}
+    self._key_refs = collections.Counter()
+    # With ndb_keys_as_interned, the paths of the Keys of one document and the kinds they use, each with
+    # a dict of their indexes. The table is written before the document, which is held until it is complete.
+    self._keys_interned = keys_as_interned
+    self._key_paths = []
+    self._key_ids = {}
+    self._kinds = []
+    self._kind_ids = {}
 
     if keys_as_pairs:
       self._ndb_type_encoding[ndb.Key] = encode_key_as_pair
     elif keys_as_urlsafe:
       self._ndb_type_encoding[ndb.Key] = encode_key_as_urlsafe
+    elif keys_as_interned:
+      self._ndb_type_encoding[ndb.Key] = self._encode_key_interned
+    elif keys_memo:
+      self._entities = {}
+      self._encoded = {}
+      # Entities are expanded eagerly so that cycles and depth can be tracked across nested Keys.
+      self._model_encoding = self._ndb_type_encoding[ndb.MetaModel]
+      self._ndb_type_encoding[ndb.MetaModel] = self._encode_model_memo
+      self._ndb_type_encoding[ndb.Key] = self._encode_key_memo
+    elif keys_batched:
+      self._entities = {}
+      self._ndb_type_encoding[ndb.Key] = self._encode_key_prefetched
+    elif self._key_window:
+      self._ndb_type_encoding[ndb.Key] = self._encode_key_windowed
     else:
       self._ndb_type_encoding[ndb.Key] = encode_key_as_entity
 
 
+    backend = kwargs.pop('ndb_backend', None)
+    self._backend = None if backend is None else get_json_backend(backend)
+
+    self._cache = kwargs.pop('ndb_cache', None)
+    if self._cache is not None:
+      # Fragments embedding the entities of Keys would go stale when those change.
+      if not (keys_as_pairs or keys_as_urlsafe):
+        raise ValueError('Argument ndb_cache can only be used when encoding Keys as pairs or URL-safe strings')
+      if self._backend is not None:
+        raise ValueError('Argument ndb_cache can not be used with ndb_backend')
+      # Fragments are encoded on their own, so they couldn't be indented to their depth in the output.
+      if kwargs.get('indent') is not None:
+        raise ValueError('Argument ndb_cache can not be used with indent')
+
+    self._stats = _get_stats(kwargs)
+    if self._stats is not None:
+      for obj_type, fn in self._ndb_type_encoding.items():
+        self._ndb_type_encoding[obj_type] = self._wrap_encoding(obj_type, fn)
+
+    self._ndb_types = NDB_TYPES
+    # Encoder functions resolved by default(), keyed by the type of the encoded object.
+    self._type_cache = {}
+
     json.JSONEncoder.__init__(self, **kwargs)
 
+    if self._cache is not None:
+      self._cache_fingerprint = self._get_cache_fingerprint()
+
+  def _wrap_encoding(self, obj_type, fn):
+    """Wrap an encoder function to record its calls in the stats."""
+    return self._stats.wrap(fn, rpc=fn is encode_key_as_entity, wait=obj_type is ndb.Future)
+
+  def _wait(self, future):
+    """Get the result of a Future, recording the time blocked on it in the stats."""
+    if self._stats is None:
+      return future.get_result()
+    start = time.time()
+    try:
+      return future.get_result()
+    finally:
+      self._stats.wait_time += time.time() - start
+
+  def _get_cache_fingerprint(self):
+    """Get a digest of the options which change the encoding of an entity, to key its cached fragments."""
+    blobs = self._blobs
+    if callable(blobs):
+      blobs = '%s.%s' % (blobs.__module__, blobs.__name__)
+    options = (
+        self.item_separator, self.key_separator, self.sort_keys, self.ensure_ascii, self.allow_nan,
+        self.indent, self._ndb_type_encoding[ndb.Key].__name__, _fields_repr(self._include),
+        _fields_repr(self._exclude), blobs)
+    return hashlib.sha1(repr(options)).hexdigest()[:16]
+
+  def _reset(self):
+    """Clear the caches kept for the duration of one encoding call."""
+    if self._entities is not None:
+      self._entities = {}
+    if self._encoded is not None:
+      self._encoded = {}
+    self._splices = {}
+    self._key_futures = {}
+    self._key_refs.clear()
+
+  @ndb.tasklet
+  def _prefetch_keys_async(self, obj):
+    """Fetch every entity reachable from `obj` through ndb.Keys, one batch per nesting level.
+
+    Pending ndb.Futures found along the way are waited on with the same batch. Returns the object
+    to encode, with a top-level ndb.Query materialized so that it is not run twice.
+    """
+    obj = yield _fetch_results_async(obj)
+    pending = set()
+    futures = set()
+    _collect_keys(obj, pending, self._get_serializer, futures)
+    # Memoized Keys nested deeper than ndb_keys_max_depth are encoded with the fallback, so they aren't fetched.
+    max_levels = self._keys_max_depth if self._encoded is not None else None
+    level = 0
+    while (pending or futures) and (max_levels is None or level < max_levels):
+      level += 1
+      keys = list(pending)
+      if self._stats is not None and keys:
+        self._stats.rpcs += 1
+      results = yield ndb.get_multi_async(keys) + list(futures)
+      pending = set()
+      futures = set()
+      for key, entity in zip(keys, results):
+        self._entities[key] = entity
+      # Entities and Future results may reference more Keys, which are fetched with the next batch.
+      for result in results:
+        _collect_keys(result, pending, self._get_serializer, futures)
+      pending.difference_update(self._entities)
+    raise ndb.Return(obj)
+
+  def _prefetch_keys(self, obj):
+    """Synchronous version of `_prefetch_keys_async`."""
+    return self._wait(self._prefetch_keys_async(obj))
+
+  @ndb.tasklet
+  def _prepare_async(self, o):
+    """Start an encoding call: clear its caches, project a query and fetch its results, and fetch the
+    entities of its Keys when they are batched. Returns the object to encode.
+    """
+    self._reset()
+    o = yield _fetch_results_async(self._project_query(o))
+    if self._keys_batched:
+      o = yield self._prefetch_keys_async(o)
+    elif self._cache is not None:
+      self._prefetch_fragments(o)
+    raise ndb.Return(o)
+
+  def _prepare(self, o):
+    """Synchronous version of `_prepare_async`, which only runs a tasklet when there are Keys to fetch."""
+    if self._keys_batched:
+      return self._wait(self._prepare_async(o))
+    self._reset()
+    o = self._project_query(o)
+    if self._cache is not None:
+      if isinstance(o, (ndb.Query, ndb.QueryIterator)):
+        o = list(o)
+      self._prefetch_fragments(o)
+    return o
+
+  @ndb.tasklet
+  def _prepare_page_async(self, page):
+    """Fetch the entities of the Keys of a page of streamed values, when they are batched."""
+    if self._keys_batched:
+      if self._encoded is None:
+        # Without memoization, entities are only needed for the page they were fetched for.
+        self._entities = {}
+      page = yield self._prefetch_keys_async(page)
+    if self._cache is not None:
+      self._prefetch_fragments(page)
+    raise ndb.Return(page)
+
+  def _get_serializer(self, model_class):
+    """Get the ModelSerializer for the properties of `model_class` selected by this encoder."""
+    try:
+      return self._serializers[model_class]
+    except KeyError:
+      kind = model_class._get_kind()
+      serializer = self._serializers[model_class] = get_model_serializer(
+          model_class, _select_fields(self._include, kind), _select_fields(self._exclude, kind), self._blobs,
+          self.model_serializer_class)
+      return serializer
+
+  def _encode_model(self, obj):
+    """Encode an ndb.Model with the selected properties and blob encoding of this encoder."""
+    if isinstance(obj, ndb.Model):
+      if self._cache is not None and obj.key is not None:
+        return self._encode_model_cached(obj)
+      return self._get_serializer(type(obj))(obj)
+    return encode_model(obj)
+
+  def _encode_model_cached(self, obj):
+    """Encode an entity as a string which _splice replaces with its cached fragment, encoding it on a miss."""
+    cache_key = self._cache.make_key(self._cache_fingerprint, obj.key)
+    version = self._cache.get_version(obj)
+    fragment = self._cache.get(cache_key, version)
+    if fragment is None:
+      fragment = ''.join(self._splice(json.JSONEncoder.iterencode(self, self._get_serializer(type(obj))(obj), True)))
+      self._cache.set(cache_key, version, fragment)
+    return self._add_splice((fragment,), quoted=False)
+
+  def _prefetch_fragments(self, obj):
+    """Load the cached fragments of an entity, or a list of entities, with one memcache RPC."""
+    entities = [obj] if isinstance(obj, ndb.Model) else obj if isinstance(obj, (list, tuple)) else ()
+    self._cache.prefetch([self._cache.make_key(self._cache_fingerprint, entity.key) for entity in entities
+                          if isinstance(entity, ndb.Model) and entity.key is not None])
+
+  def _flush_cache(self):
+    """Write the fragments encoded since the last flush to memcache."""
+    if self._cache is not None:
+      self._cache.flush()
+
+  def _iter_then_flush_cache(self, chunks):
+    """Yield the chunks, then write the fragments encoded for them to memcache."""
+    for chunk in chunks:
+      yield chunk
+    self._flush_cache()
+
+  def _project_query(self, obj):
+    """Get an ndb.Query which only fetches the selected properties, when they can be projected.
+
+    Other objects, and queries whose selected properties can't be projected, are returned as-is.
+    """
+    if not self._project_queries or not isinstance(obj, ndb.Query) or obj.projection or obj.group_by:
+      return obj
+    model_class = ndb.Model._kind_map.get(obj.kind)
+    if model_class is None:
+      return obj
+    projection = self._get_serializer(model_class).get_projection()
+    # The datastore rejects projections of properties which are filtered for equality.
+    if projection is None or _equality_filter_names(obj.filters).intersection(projection):
+      return obj
+    return obj.__class__(
+        kind=obj.kind, ancestor=obj.ancestor, filters=obj.filters, orders=obj.orders, app=obj.app,
+        namespace=obj.namespace, default_options=obj.default_options, projection=projection)
+
+  def _encode_key_interned(self, obj):
+    """Encode an ndb.Key as a reference to its path in the table of Keys of the document."""
+    return {KEY_REF: self._intern_key(obj)}
+
+  def _intern_key(self, key):
+    """Get the index of the path of an ndb.Key in the table of Keys, adding it and its ancestors if needed."""
+    try:
+      return self._key_ids[key]
+    except KeyError:
+      pass
+    parent = key.parent()
+    parent_id = None if parent is None else self._intern_key(parent)
+    kind = key.kind()
+    try:
+      kind_id = self._kind_ids[kind]
+    except KeyError:
+      kind_id = self._kind_ids[kind] = len(self._kinds)
+      self._kinds.append(kind)
+    path = [kind_id, key.id()] if parent_id is None else [parent_id, kind_id, key.id()]
+    index = self._key_ids[key] = len(self._key_paths)
+    self._key_paths.append(path)
+    return index
+
+  def _iter_interned(self, chunks):
+    """Encode a document and the table of the Keys it references, as {"__ndb_keys__": table, "__ndb_data__": data}."""
+    # The Keys are only known once the whole document is encoded.
+    data = list(chunks)
+    table = {'kinds': self._kinds, 'paths': self._key_paths}
+    newline_indent = '' if self.indent is None else '\n' + ' ' * self.indent
+    yield '{%s"%s"%s' % (newline_indent, KEY_TABLE, self.key_separator)
+    for chunk in json.JSONEncoder.iterencode(self, table):
+      yield chunk.replace('\n', newline_indent) if newline_indent else chunk
+    yield '%s%s"%s"%s' % (self.item_separator, newline_indent, KEY_DATA, self.key_separator)
+    for chunk in data:
+      yield chunk.replace('\n', newline_indent) if newline_indent else chunk
+    yield '\n}' if newline_indent else '}'
+
+  def _encode_key_prefetched(self, obj):
+    """Get the prefetched Entity for the ndb.Key, falling back to `encode_key_as_entity` on a miss."""
+    try:
+      return self._entities[obj]
+    except KeyError:
+      return encode_key_as_entity(obj)
+
+  def _encode_key_windowed(self, obj):
+    """Get the Future of the entity fetched ahead for the ndb.Key, or fetch it now on a miss."""
+    try:
+      return self._key_futures[obj]
+    except KeyError:
+      return encode_key_as_entity(obj)
+
+  def _iter_window_values(self, values):
+    """Yield the values, with the entities of the Keys of the next `ndb_key_window` values being fetched.
+
+    The fetches of a value are started as it enters the window, so that their RPCs run while the
+    values ahead of it are encoded and written.
+    """
+    window = collections.deque()
+    iterator = iter(values)
+    exhausted = False
+    while True:
+      while not exhausted and len(window) <= self._key_window:
+        try:
+          value = next(iterator)
+        except StopIteration:
+          exhausted = True
+          break
+        keys = set()
+        _collect_keys(value, keys, self._get_serializer)
+        for key in keys:
+          if key not in self._key_futures:
+            self._key_futures[key] = key.get_async()
+            if self._stats is not None:
+              self._stats.rpcs += 1
+          self._key_refs[key] += 1
+        window.append((value, keys))
+      if not window:
+        return
+      value, keys = window.popleft()
+      yield value
+      # The value has been encoded, so the Futures which no other value in the window needs are released.
+      for key in keys:
+        self._key_refs[key] -= 1
+        if not self._key_refs[key]:
+          del self._key_refs[key]
+          del self._key_futures[key]
+
+  def _get_entity(self, key):
+    """Get the Entity for the ndb.Key, fetching it at most once per encoding call."""
+    try:
+      return self._entities[key]
+    except KeyError:
+      if self._stats is not None:
+        self._stats.rpcs += 1
+      entity = self._entities[key] = self._wait(key.get_async())
+      return entity
+
+  def _expand_key(self, key, stack, depth):
+    """Encode the Entity for the ndb.Key, or its fallback form on a cycle or past the depth limit."""
+    if key in stack or (self._keys_max_depth is not None and depth >= self._keys_max_depth):
+      return self._keys_fallback(key)
+    try:
+      return self._encoded[key]
+    except KeyError:
+      pass
+    entity = self._get_entity(key)
+    encoded = None if entity is None else self._expand_entity(entity, stack, depth + 1)
+    self._encoded[key] = encoded
+    return encoded
+
+  def _expand_entity(self, entity, stack, depth):
+    """Encode an Entity, expanding the Keys it references while it is on the stack."""
+    stack.append(entity.key)
+    try:
+      return self._expand_value(self._model_encoding(entity), stack, depth)
+    finally:
+      stack.pop()
+
+  def _expand_value(self, val, stack, depth):
+    """Replace the ndb.Keys found in an encoded Entity value with their expanded form."""
+    if isinstance(val, ndb.Key):
+      return self._expand_key(val, stack, depth)
+    if isinstance(val, dict):
+      return {k: self._expand_value(v, stack, depth) for k, v in val.iteritems()}
+    if isinstance(val, list):
+      return [self._expand_value(v, stack, depth) for v in val]
+    return val
+
+  def _encode_model_memo(self, obj):
+    """Encode an ndb.Model, memoizing the entities of the Keys it references."""
+    return self._expand_entity(obj, [], 0)
+
+  def _encode_key_memo(self, obj):
+    """Encode an ndb.Key as its memoized Entity."""
+    return self._expand_key(obj, [], 0)
+
+  def iterencode(self, o, _one_shot=False):
+    """Encode the given object, fetching referenced entities up front when Keys are batched."""
+    chunks = self._iterencode_value(self._prepare(o), _one_shot)
+    if self._cache is not None:
+      chunks = self._iter_then_flush_cache(chunks)
+    return chunks
+
+  def _iterencode_value(self, o, _one_shot=False):
+    """Encode the given object, with the JSON backend if one was selected, and the table of its Keys
+    when they are interned.
+    """
+    if self._keys_interned:
+      self._key_paths, self._key_ids, self._kinds, self._kind_ids = [], {}, [], {}
+    if self._backend is not None:
+      chunks = iter([self._backend.dumps(self._convert(o), self)])
+    else:
+      chunks = self._splice(json.JSONEncoder.iterencode(self, o, _one_shot))
+    if self._keys_interned:
+      chunks = self._iter_interned(chunks)
+    if self._stats is not None:
+      chunks = self._stats.count_bytes(chunks)
+    return chunks
+
+  def _add_splice(self, chunks, quoted):
+    """Get a string which _splice replaces with `chunks` in the output: inside its quotes when `quoted`,
+    or as raw JSON otherwise.
+    """
+    token = '%s%d' % (self._splice_token, next(self._splice_ids))
+    self._splices[token] = (quoted, chunks)
+    return token
+
+  def _encode_blob_value(self, obj):
+    """Encode a BlobValue as a string which _splice replaces with its base64 encoding."""
+    chunks = iter_base64(obj.value)
+    if self._stats is not None:
+      chunks = self._stats.time_iter('iter_base64', chunks)
+    return self._add_splice(chunks, quoted=True)
+
+  def _splice(self, chunks):
+    """Replace the strings standing in for blobs and fragments in the encoded chunks with their chunks."""
+    marker = '"' + self._splice_token
+    for chunk in chunks:
+      start = chunk.find(marker) if self._splices else -1
+      while start != -1:
+        end = chunk.index('"', start + 1)
+        quoted, parts = self._splices.pop(chunk[start + 1:end])
+        if quoted:
+          start += 1
+        else:
+          end += 1
+        yield chunk[:start]
+        for part in parts:
+          yield part
+        chunk = chunk[end:]
+        start = chunk.find(marker)
+      yield chunk
+
+  def convert(self, o):
+    """Convert an object into JSON-compatible Python types, using the same NDB conversions as `default`."""
+    return self._convert(self._prepare(o))
+
+  def _convert(self, o):
+    """Recursively convert an object into JSON-compatible Python types."""
+    if type(o) in _PRIMITIVE_TYPES:
+      return o
+    if isinstance(o, dict):
+      return {k: self._convert(v) for k, v in o.iteritems()}
+    if isinstance(o, (list, tuple)):
+      return [self._convert(v) for v in o]
+    if isinstance(o, (basestring, int, long, float)):
+      return o
+    if isinstance(o, BlobValue):
+      return encode_blob_value(o)
+    return self._convert(self.default(o))
+
+  def _iter_page_values(self, pages):
+    """Iterate over the values of each page in turn, fetching their Keys one page at a time when
+    batched, or ahead of the writer with `ndb_key_window`.
+    """
+    self._reset()
+    values = self._iter_pages_flat(pages)
+    if self._key_window:
+      values = self._iter_window_values(values)
+    return values
+
+  def _iter_pages_flat(self, pages):
+    """Yield the values of each page in turn, prefetching their Keys one page at a time when batched."""
+    for page in pages:
+      if self._keys_batched:
+        page = self._wait(self._prepare_page_async(page))
+      elif self._cache is not None:
+        self._prefetch_fragments(page)
+      for value in page:
+        yield value
+    self._flush_cache()
+
+  def _array_delimiters(self):
+    """Get the strings which open a streamed JSON array, separate its items and close it, and the
+    newline and indentation of its items (None when not indented).
+    """
+    if self.indent is None:
+      return '[', self.item_separator, ']', None
+    newline_indent = '\n' + ' ' * self.indent
+    return '[' + newline_indent, self.item_separator + newline_indent, '\n]', newline_indent
+
+  def _iterencode_item(self, value, newline_indent):
+    """Encode a value as an item of a streamed JSON array."""
+    for chunk in self._iterencode_value(value):
+      if newline_indent is not None:
+        # Indent the nested value one level deeper, as the items of a list.
+        chunk = chunk.replace('\n', newline_indent)
+      yield chunk
+
+  def _iterencode_array(self, pages):
+    """Encode pages of values as one JSON array, holding no more than one page at a time."""
+    start, separator, end, newline_indent = self._array_delimiters()
+    first = True
+    for value in self._iter_page_values(pages):
+      yield start if first else separator
+      first = False
+      for chunk in self._iterencode_item(value, newline_indent):
+        yield chunk
+    yield '[]' if first else end
+
+  def _iterencode_lines(self, pages):
+    """Encode pages of values as JSON documents, one per line."""
+    for value in self._iter_page_values(pages):
+      for chunk in self._iterencode_value(value):
+        yield chunk
+      yield '\n'
+
   def default(self, obj):
     """Overriding the default JSONEncoder.default for NDB support."""
     obj_type = type(obj)
+    try:
+      fn = self._type_cache[obj_type]
+    except KeyError:
+      fn = self._resolve_encoding(obj)
+      # Instances of old-style classes all share one type, so they can't be cached.
+      if obj_type is not types.InstanceType:
+        self._type_cache[obj_type] = fn
+
+    if fn:
+      return fn(obj)
+
+    return json.JSONEncoder.default(self, obj)
+
+  def _resolve_encoding(self, obj):
+    """Find the encoder function for an object whose type has not been seen yet."""
+    obj_type = type(obj)
     # NDB Models return a repr to calls from type().
     if obj_type not in self._ndb_type_encoding:
       if hasattr(obj, '__metaclass__'):
         obj_type = obj.__metaclass__
       else:
         # Try to encode subclasses of types
-        for ndb_type in NDB_TYPES:
+        for ndb_type in self._ndb_types:
           if isinstance(obj, ndb_type):
             obj_type = ndb_type
             break
 
-    fn = self._ndb_type_encoding.get(obj_type)
+    return self._ndb_type_encoding.get(obj_type)
 
-    if fn:
-      return fn(obj)
-
-    return json.JSONEncoder.default(self, obj)
+  def register(self, obj_type, fn):
+    """Register an encoder function for `obj_type` and its subclasses, on this encoder only."""
+    if self._stats is not None:
+      fn = self._wrap_encoding(obj_type, fn)
+    self._ndb_type_encoding[obj_type] = fn
+    self._ndb_types = _sort_types(self._ndb_type_encoding)
+    self._type_cache.clear()
 
 
 def dumps(ndb_model, **kwargs):
-  """Custom json dumps using the custom encoder above."""
+  """Custom json dumps using the custom encoder above.
+
+  With `ndb_include` and/or `ndb_exclude`, only the named properties of entities are encoded, and
+  only their Keys are fetched. Either can be a list of property names for every kind, or a dict of
+  such lists by kind. With `ndb_project_query=True`, an ndb.Query is also run as a projection query
+  of the selected properties when they can all be projected.
+  """
   return NdbEncoder(**kwargs).encode(ndb_model)
 
 
 def dump(ndb_model, fp, **kwargs):
-  """Custom json dump using the custom encoder above."""
-  for chunk in NdbEncoder(**kwargs).iterencode(ndb_model):
+  """Custom json dump using the custom encoder above.
+
+  With `ndb_stream=True`, an ndb.Query (or other iterable) is fetched and written as a JSON array
+  one page of `ndb_page_size` results at a time, rather than being loaded in memory as a whole.
+  """
+  stream = kwargs.pop('ndb_stream', False)
+  page_size = kwargs.pop('ndb_page_size', STREAM_PAGE_SIZE)
+  encoder = NdbEncoder(**kwargs)
+  if stream and isinstance(ndb_model, STREAM_TYPES):
+    _check_streamable(encoder)
+    chunks = encoder._iterencode_array(_iter_pages(encoder._project_query(ndb_model), page_size))
+  else:
+    chunks = encoder.iterencode(ndb_model)
+  for chunk in chunks:
     fp.write(chunk)
 
 
+def _check_streamable(encoder):
+  """Check that the options of an encoder allow writing a streamed JSON array."""
+  if encoder._keys_interned:
+    # The table of Keys would have to be written before the first page is encoded.
+    raise ValueError('Argument ndb_keys_as_interned can not be used with ndb_stream')
+
+
+def _batch_keys_async(kwargs):
+  """Fetch Keys in batches by default in the async API, so that they are fetched without blocking.
+
+  Keys fetched ahead of the writer with `ndb_key_window` are left unbatched.
+  """
+  if not (kwargs.get('ndb_keys_as_pairs') or kwargs.get('ndb_keys_as_urlsafe')
+          or kwargs.get('ndb_keys_as_interned') or kwargs.get('ndb_key_window')):
+    kwargs.setdefault('ndb_keys_batched', True)
+
+
+@ndb.tasklet
+def _fetch_pages_async(obj, page_size, callback):
+  """Fetch the results of an ndb.Query, or the items of an iterable, in pages like `_iter_pages`,
+  and wait on the tasklet `callback(page)` for each page in turn.
+  """
+  if isinstance(obj, ndb.Query) and not _pages_by_cursor(obj):
+    iterator = obj.iter(batch_size=page_size)
+    page = []
+    while (yield iterator.has_next_async()):
+      page.append(iterator.next())
+      if len(page) == page_size:
+        yield callback(page)
+        page = []
+    if page:
+      yield callback(page)
+  elif isinstance(obj, ndb.Query):
+    future = obj.fetch_page_async(page_size)
+    while future is not None:
+      results, cursor, more = yield future
+      if more and cursor:
+        future = obj.fetch_page_async(page_size, start_cursor=cursor)
+      else:
+        future = None
+      if results:
+        yield callback(results)
+  else:
+    for page in _iter_pages(obj, page_size):
+      yield callback(page)
+
+
+@ndb.tasklet
+def dumps_async(ndb_model, **kwargs):
+  """Tasklet version of `dumps`, which returns an ndb.Future of the JSON string.
+
+  Queries and the entities of Keys are fetched by yielding to the event loop, so other tasklets run
+  in the meantime. Keys are fetched in batches (`ndb_keys_batched`) unless encoded as pairs or strings.
+  """
+  _batch_keys_async(kwargs)
+  encoder = NdbEncoder(**kwargs)
+  obj = yield encoder._prepare_async(ndb_model)
+  json_str = ''.join(encoder._iterencode_value(obj, _one_shot=True))
+  encoder._flush_cache()
+  raise ndb.Return(json_str)
+
+
+@ndb.tasklet
+def dump_async(ndb_model, fp, **kwargs):
+  """Tasklet version of `dump`, which returns an ndb.Future that is done once everything is written.
+
+  With `ndb_stream=True`, each page of results, and the entities of its Keys, are fetched by yielding
+  to the event loop before the page is written.
+  """
+  stream = kwargs.pop('ndb_stream', False)
+  page_size = kwargs.pop('ndb_page_size', STREAM_PAGE_SIZE)
+  _batch_keys_async(kwargs)
+  encoder = NdbEncoder(**kwargs)
+  if not (stream and isinstance(ndb_model, STREAM_TYPES)):
+    obj = yield encoder._prepare_async(ndb_model)
+    for chunk in encoder._iterencode_value(obj):
+      fp.write(chunk)
+    encoder._flush_cache()
+    return
+
+  _check_streamable(encoder)
+  start, separator, end, newline_indent = encoder._array_delimiters()
+  state = {'first': True}
+
+  @ndb.tasklet
+  def write_page(page):
+    page = yield encoder._prepare_page_async(page)
+    for value in page:
+      fp.write(start if state['first'] else separator)
+      state['first'] = False
+      for chunk in encoder._iterencode_item(value, newline_indent):
+        fp.write(chunk)
+
+  encoder._reset()
+  yield _fetch_pages_async(encoder._project_query(ndb_model), page_size, write_page)
+  fp.write('[]' if state['first'] else end)
+  encoder._flush_cache()
+
+
+def dump_lines(ndb_model, fp, **kwargs):
+  """Write an ndb.Query (or other iterable) as JSON Lines: one JSON document per result, per line.
+
+  Results are fetched and written one page of `ndb_page_size` results at a time.
+  """
+  if kwargs.get('indent') is not None:
+    raise ValueError('Argument indent can not be used with dump_lines')
+  page_size = kwargs.pop('ndb_page_size', STREAM_PAGE_SIZE)
+  if not isinstance(ndb_model, STREAM_TYPES):
+    ndb_model = [ndb_model]
+  encoder = NdbEncoder(**kwargs)
+  for chunk in encoder._iterencode_lines(_iter_pages(encoder._project_query(ndb_model), page_size)):
+    fp.write(chunk)
+
+
+# The NdbEncoder of a dump_parallel worker process, and the ndb.Query whose pages it fetches.
+_parallel_encoder = None
+_parallel_query = None
+
+
+def _init_parallel_worker(kwargs, query):
+  """Create the NdbEncoder of a dump_parallel worker process."""
+  global _parallel_encoder, _parallel_query
+  _parallel_encoder = NdbEncoder(**kwargs)
+  _parallel_query = query
+
+
+def _encode_parallel_page(values, separator):
+  """Encode a page of results in a dump_parallel worker, and return them joined by `separator`."""
+  return separator.join(_parallel_encoder.encode(val) for val in values)
+
+
+def _encode_parallel_range(start_cursor, end_cursor, separator):
+  """Fetch the results of the query between two cursors in a dump_parallel worker, and encode them as a page."""
+  return _encode_parallel_page(_parallel_query.fetch(start_cursor=start_cursor, end_cursor=end_cursor), separator)
+
+
+def _iter_cursor_ranges(query, page_size):
+  """Yield the (start cursor, end cursor) of each page of `page_size` results of an ndb.Query.
+
+  Only the keys of the results are fetched, PARALLEL_KEYS_BATCH_SIZE at a time, along with their cursors.
+  """
+  iterator = query.iter(keys_only=True, produce_cursors=True, batch_size=PARALLEL_KEYS_BATCH_SIZE)
+  start_cursor = None
+  count = 0
+  for _ in iterator:
+    count += 1
+    if count % page_size == 0:
+      end_cursor = iterator.cursor_after()
+      yield start_cursor, end_cursor
+      start_cursor = end_cursor
+  if count % page_size:
+    yield start_cursor, iterator.cursor_after()
+
+
+def _is_parallel_query(obj):
+  """True if dump_parallel workers fetch the pages of `obj` themselves, between cursors."""
+  return isinstance(obj, ndb.Query) and not obj.projection and _pages_by_cursor(obj)
+
+
+def _iter_parallel_tasks(encoder, obj, page_size, separator):
+  """Yield the (function, arguments) of the dump_parallel worker task of each page of results.
+
+  The pages of an ndb.Query are fetched by the workers, between cursors found by a keys-only query.
+  The entities of other iterables are sent to the workers as the dictionaries of their serializer, and so
+  are those of a projection query, whose cursors hold the projected values that keys-only cursors lack,
+  and of a query which can't use cursors.
+  """
+  if _is_parallel_query(obj):
+    for start_cursor, end_cursor in _iter_cursor_ranges(obj, page_size):
+      yield _encode_parallel_range, (start_cursor, end_cursor, separator)
+    return
+  for page in _iter_pages(obj, page_size):
+    values = [encoder._get_serializer(type(val))(val) if isinstance(val, ndb.Model) else val for val in page]
+    yield _encode_parallel_page, (values, separator)
+
+
+def dump_parallel(ndb_model, fp, workers=None, **kwargs):
+  """Write the results of an ndb.Query (or other iterable) as a JSON array, encoded by a pool of processes.
+
+  The results are split into pages of `ndb_page_size`, and each page is encoded by one of `workers`
+  processes (one per CPU by default). The pages of an ndb.Query are fetched by the workers themselves,
+  between the cursors of a keys-only query. Pages are written in order, and no more than two per worker
+  are in flight at once. With `ndb_lines=True`, results are written as JSON Lines instead.
+
+  Keys are encoded as URL-safe strings unless `ndb_keys_as_pairs=True`, and can't be encoded as entities.
+  The workers are forked from the calling process, and make their datastore RPCs through its API proxy.
+  """
+  if kwargs.get('indent') is not None:
+    raise ValueError('Argument indent can not be used with dump_parallel')
+  if kwargs.get('ndb_keys_as_entities') or kwargs.get('ndb_keys_batched') or kwargs.get('ndb_keys_memo'):
+    raise ValueError('Keys can not be encoded as entities by dump_parallel')
+  if kwargs.get('ndb_keys_as_interned'):
+    raise ValueError('Keys can not be interned by dump_parallel')
+  if not kwargs.get('ndb_keys_as_pairs'):
+    kwargs['ndb_keys_as_urlsafe'] = True
+  page_size = kwargs.pop('ndb_page_size', STREAM_PAGE_SIZE)
+  lines = kwargs.pop('ndb_lines', False)
+  # Also validates the arguments before any worker is started.
+  encoder = NdbEncoder(**kwargs)
+  separator = '\n' if lines else encoder.item_separator
+  if not isinstance(ndb_model, STREAM_TYPES):
+    ndb_model = [ndb_model]
+  ndb_model = encoder._project_query(ndb_model)
+  query = ndb_model if _is_parallel_query(ndb_model) else None
+
+  workers = workers or multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(workers, _init_parallel_worker, (kwargs, query))
+  try:
+    if not lines:
+      fp.write('[')
+    first = True
+    pending = collections.deque()
+    for task in itertools.chain(_iter_parallel_tasks(encoder, ndb_model, page_size, separator), [None]):
+      if task is not None:
+        pending.append(pool.apply_async(*task))
+      # Write the finished pages in order, waiting for the oldest one when the window is full.
+      while pending and (task is None or len(pending) >= workers * 2 or pending[0].ready()):
+        chunk = pending.popleft().get()
+        if lines:
+          fp.write(chunk + '\n')
+        else:
+          if not first:
+            fp.write(separator)
+          fp.write(chunk)
+        first = False
+    if not lines:
+      fp.write(']')
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def load(fp, **kwargs):
+  """Custom json load function that converts datetime strings, like `loads`.
+
+  With `ndb_stream=True`, a JSON array is parsed `ndb_chunk_size` characters at a time, and an iterator
+  over its decoded items is returned, so that the whole document is never held in memory.
+  """
+  stream = kwargs.pop('ndb_stream', False)
+  chunk_size = kwargs.pop('ndb_chunk_size', STREAM_CHUNK_SIZE)
+  decoder = NdbDecoder(**kwargs)
+  if stream:
+    return decoder.iterdecode(fp, chunk_size)
+  return decoder.decode(fp.read())
+
+
 def loads(json_str, **kwargs):
-  """Custom json loads function that converts datetime strings."""
+  """Custom json loads function that converts datetime strings.
+
+  With `ndb_model=MyModel`, a JSON object is decoded into a MyModel entity (and a JSON array into
+  a list of them), using the declared properties of MyModel to decode dates, blobs and Keys.
+  """
   return NdbDecoder(**kwargs).decode(json_str)
+
+
+def load_lines(fp, **kwargs):
+  """Parse JSON Lines from a file-like object, lazily yielding the value decoded from each line."""
+  decoder = NdbDecoder(**kwargs)
+  for line in fp:
+    line = line.strip()
+    if line:
+      yield decoder.decode(line)
+
+
+# The result of `import_entities`: the number of entities put, and a list of BatchErrors.
+ImportResult = collections.namedtuple('ImportResult', ('count', 'errors'))
+
+# A batch of entities which `import_entities` failed to put: its index in the input, its entities,
+# and the exception raised by the put.
+BatchError = collections.namedtuple('BatchError', ('index', 'entities', 'exception'))
+
+
+def _wait_batch(index, batch, futures, errors):
+  """Wait for the put of a batch of entities, recording its error. Returns the number of entities put."""
+  ndb.Future.wait_all(futures)
+  exceptions = [future.get_exception() for future in futures]
+  failed = [exception for exception in exceptions if exception is not None]
+  if failed:
+    errors.append(BatchError(index, batch, failed[0]))
+  return len(futures) - len(failed)
+
+
+def import_entities(fp, ndb_model, batch_size=100, max_pending=4, transform=None, **kwargs):
+  """Decode entities of `ndb_model` from a JSON array in a file-like object, and put them in batches.
+
+  The input is decoded incrementally, like `load(fp, ndb_stream=True)`, or as JSON Lines with
+  `ndb_lines=True`. Entities are put with one `ndb.put_multi_async` per `batch_size` entities, and
+  decoding waits for the oldest batch when `max_pending` are in flight. `transform`, when given, is
+  called with each entity and returns the entity to put (e.g. with its Key set), or None to skip it.
+
+  A failed batch does not stop the import: returns an ImportResult of the number of entities put,
+  and a BatchError for each failed batch, which holds its entities so that they can be put again.
+  """
+  if batch_size < 1 or max_pending < 1:
+    raise ValueError('Arguments batch_size and max_pending must be positive')
+  lines = kwargs.pop('ndb_lines', False)
+  if lines and 'ndb_chunk_size' in kwargs:
+    # JSON Lines are read one line at a time.
+    raise ValueError('Argument ndb_chunk_size can not be used with ndb_lines')
+  kwargs['ndb_model'] = ndb_model
+  entities = load_lines(fp, **kwargs) if lines else load(fp, ndb_stream=True, **kwargs)
+  if transform is not None:
+    entities = (entity for entity in itertools.imap(transform, entities) if entity is not None)
+  count = 0
+  errors = []
+  pending = collections.deque()
+  for index, batch in enumerate(_iter_pages(entities, batch_size)):
+    pending.append((index, batch, ndb.put_multi_async(batch)))
+    # The RPCs of the other batches keep running while the oldest one is waited on.
+    while len(pending) >= max_pending:
+      count += _wait_batch(*pending.popleft(), errors=errors)
+  while pending:
+    count += _wait_batch(*pending.popleft(), errors=errors)
+  return ImportResult(count, errors)
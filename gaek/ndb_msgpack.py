@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+MessagePack encoder/decoder adapted for use with Google App Engine NDB.
+
+A binary alternative to `ndb_json` with the same functions and options, for traffic between services.
+Values are converted with the same NDB type encoders as `ndb_json`, except that datetimes, dates and Keys
+are written as MessagePack extension types, and blobs as binary, rather than as strings.
+
+Usage:
+
+  from gaek import ndb_msgpack
+
+  # Serialize an ndb.Query into an array of maps.
+  data = ndb_msgpack.dumps(models.MyModel.query())
+
+  # Convert into a list of Python dictionaries, or of MyModel entities.
+  query_dicts = ndb_msgpack.loads(data)
+  entities = ndb_msgpack.loads(data, ndb_model=models.MyModel)
+
+
+Dependencies:
+
+  - msgpack: https://pypi.python.org/pypi/msgpack
+"""
+
+__author__ = 'Eric Higgins'
+__copyright__ = 'Copyright 2013-2016, Eric Higgins'
+__email__ = 'erichiggins@gmail.com'
+
+
+import datetime
+import struct
+
+from google.appengine.ext import ndb
+
+from gaek import ndb_json
+from gaek._lazy import LazyModule
+
+msgpack = LazyModule('msgpack')
+
+
+__all__ = (
+    'dump',
+    'dumps',
+    'loads',
+    'MsgpackEncoder',
+)
+
+
+# Codes of the MessagePack extension types.
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_KEY = 3
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Media type of the output, e.g. for the Content-Type header.
+CONTENT_TYPE = 'application/x-msgpack'
+
+
+def _timedelta_to_microseconds(delta):
+  """Convert a datetime.timedelta into an integer number of microseconds."""
+  return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def encode_ext(obj):
+  """Encode a datetime, date or ndb.Key as a MessagePack extension type."""
+  if isinstance(obj, datetime.datetime):
+    offset = obj.utcoffset()
+    if offset is None:
+      return msgpack.ExtType(EXT_DATETIME, struct.pack('>q', _timedelta_to_microseconds(obj - EPOCH)))
+    # Offset-aware datetimes are stored in UTC, along with their offset in minutes.
+    utc = obj.replace(tzinfo=None) - offset
+    return msgpack.ExtType(EXT_DATETIME, struct.pack(
+        '>qh', _timedelta_to_microseconds(utc - EPOCH), _timedelta_to_microseconds(offset) // 60000000))
+  if isinstance(obj, datetime.date):
+    return msgpack.ExtType(EXT_DATE, struct.pack('>i', obj.toordinal()))
+  if isinstance(obj, ndb.Key):
+    return msgpack.ExtType(EXT_KEY, obj.serialized())
+  raise TypeError('%r is not MessagePack serializable' % (obj,))
+
+
+def decode_ext(code, data):
+  """Decode the MessagePack extension types written by `encode_ext`."""
+  if code == EXT_DATETIME:
+    if len(data) == 8:
+      return EPOCH + datetime.timedelta(microseconds=struct.unpack('>q', data)[0])
+    microseconds, minutes = struct.unpack('>qh', data)
+    dt = EPOCH + datetime.timedelta(microseconds=microseconds, minutes=minutes)
+    return dt.replace(tzinfo=ndb_json.FixedOffset(minutes))
+  if code == EXT_DATE:
+    return datetime.date.fromordinal(struct.unpack('>i', data)[0])
+  if code == EXT_KEY:
+    return ndb.Key(serialized=data)
+  return msgpack.ExtType(code, data)
+
+
+# Property values which MessagePack holds natively are written as-is.
+PROPERTY_TYPE_ENCODING = dict.fromkeys(ndb_json.PROPERTY_TYPE_ENCODING)
+
+PROPERTY_TYPE_DECODING = {
+  ndb.KeyProperty: ndb_json.decode_key,
+}
+
+
+class ModelSerializer(ndb_json.ModelSerializer):
+  """Encodes the instances of one ndb.Model class like `ndb_json.ModelSerializer`, keeping the
+  values of dates and blobs native.
+  """
+
+  property_encoding = PROPERTY_TYPE_ENCODING
+
+  # Blobs of all sizes are written as binary.
+  defer_blob_size = 0
+
+  def _encode_generic(self, entity, name, prop, values):
+    """Encode a property of unknown value type, keeping binary strings as they are."""
+    try:
+      values[name] = prop._get_for_dict(entity)
+    except ndb.UnprojectedPropertyError:
+      pass
+
+
+class ModelDeserializer(ndb_json.ModelDeserializer):
+  """Builds instances of one ndb.Model class from decoded MessagePack maps, using its declared properties."""
+
+  property_decoding = PROPERTY_TYPE_DECODING
+
+
+class MsgpackEncoder(ndb_json.NdbEncoder):
+  """Encoder of NDB values as MessagePack, with the options of `ndb_json.NdbEncoder`.
+
+  Keys are written as an extension type, unless one of the `ndb_keys_as_*` options is given.
+  BlobProperty values are written as binary, unless `ndb_blobs` is 'omit' or a function.
+  """
+
+  model_serializer_class = ModelSerializer
+
+  def __init__(self, **kwargs):
+    for name in ('ndb_backend', 'ndb_cache', 'ndb_key_window', 'ndb_keys_as_interned'):
+      if kwargs.get(name):
+        raise ValueError('Argument %s can not be used with MessagePack' % name)
+    key_options = ('ndb_keys_as_entities', 'ndb_keys_as_pairs', 'ndb_keys_as_urlsafe',
+                   'ndb_keys_batched', 'ndb_keys_memo')
+    self._native_keys = not any(kwargs.get(name) for name in key_options)
+    if self._native_keys:
+      # Keys never reach the Key encoder, so don't let it look for Keys to fetch.
+      kwargs['ndb_keys_as_urlsafe'] = True
+    ndb_json.NdbEncoder.__init__(self, **kwargs)
+
+  def encode(self, o):
+    """Return a MessagePack binary string of a Python object."""
+    data = msgpack.packb(self.convert(o), default=encode_ext, use_bin_type=True)
+    if self._stats is not None:
+      self._stats.bytes_encoded += len(data)
+    return data
+
+  def iterencode(self, o, _one_shot=False):
+    """Encode the given object, as one binary string."""
+    return iter([self.encode(o)])
+
+  def _convert(self, o):
+    """Recursively convert an object into types which MessagePack holds, or `encode_ext` encodes."""
+    if type(o) in ndb_json._PRIMITIVE_TYPES:
+      return o
+    if isinstance(o, dict):
+      # Names are written as strings, rather than as the binary strings of Python 2.
+      return {(k.decode('utf-8') if type(k) is str else k): self._convert(v) for k, v in o.iteritems()}
+    if isinstance(o, (list, tuple)):
+      return [self._convert(v) for v in o]
+    if isinstance(o, (basestring, int, long, float, datetime.date)):
+      return o
+    if isinstance(o, ndb_json.BlobValue):
+      return o.value
+    if self._native_keys and isinstance(o, ndb.Key):
+      return o
+    return self._convert(self.default(o))
+
+
+def dumps(ndb_model, **kwargs):
+  """Serialize NDB values as a MessagePack binary string, with the options of `ndb_json.dumps`."""
+  return MsgpackEncoder(**kwargs).encode(ndb_model)
+
+
+def dump(ndb_model, fp, **kwargs):
+  """Serialize NDB values as MessagePack into a file-like object, with the options of `ndb_json.dumps`."""
+  fp.write(dumps(ndb_model, **kwargs))
+
+
+def loads(data, **kwargs):
+  """Parse a MessagePack binary string, decoding the datetimes, dates and Keys written by `dumps`.
+
+  With `ndb_model=MyModel`, a map is decoded into a MyModel entity (and an array into a list of them).
+  BlobProperty values are set from binary strings, or by calling `ndb_blobs` with the decoded value.
+  """
+  model = kwargs.pop('ndb_model', None)
+  blobs = kwargs.pop('ndb_blobs', 'base64')
+  if blobs != 'base64' and not callable(blobs):
+    raise ValueError("Argument ndb_blobs must be 'base64' or a function")
+  obj = msgpack.unpackb(data, ext_hook=decode_ext, raw=False, **kwargs)
+  if model is None:
+    return obj
+  deserializer = ndb_json.get_model_deserializer(model, blobs, ModelDeserializer)
+  if isinstance(obj, list):
+    return [deserializer(val) for val in obj]
+  return deserializer(obj)
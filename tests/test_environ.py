@@ -9,6 +9,7 @@ Tests for `environ` module.
 
 import mock
 import os
+import threading
 import unittest
 
 from google.appengine.api import app_identity
@@ -34,6 +35,7 @@ class TestEnviron(unittest.TestCase):
         # Declare which service stubs you want to use.
         self.testbed.init_app_identity_stub()
         self.testbed.init_modules_stub()
+        environ.refresh()
 
     def tearDown(self):
         self.testbed.deactivate()
@@ -57,8 +59,44 @@ class TestEnviron(unittest.TestCase):
         assert namespace_manager.google_apps_namespace == environ.google_apps_namespace
 
     def test_get_environ_dict(self):
-        # TODO(eric): This one is a bit hefty.
-        pass
+        val = environ.get_environ_dict()
+        assert set(dict(environ.ENVIRON_KEYS)) == set(val), repr(val)
+        assert 'testbed-version' == val['modules']['get_current_version_name'], repr(val)
+        assert 'testbed-version' == val['os.environ']['CURRENT_VERSION_ID'], repr(val)
+        assert 'timings' not in val, repr(val)
+
+    def test_get_environ_dict_with_keys(self):
+        val = environ.get_environ_dict(keys=('CURRENT_VERSION_ID', 'get_default_version'))
+        assert {'CURRENT_VERSION_ID': 'testbed-version'} == val['os.environ'], repr(val)
+        assert ['get_default_version'] == val['modules'].keys(), repr(val)
+        assert {} == val['app_identity'], repr(val)
+
+    def test_get_environ_dict_async(self):
+        started = {'get_versions': threading.Event(), 'get_modules': threading.Event()}
+
+        def overlapping(name, other, value):
+            def fn():
+                started[name].set()
+                # Each lookup waits for the other one to start, which only happens when they overlap.
+                if not started[other].wait(10):
+                    raise AssertionError('%s did not run concurrently with %s' % (name, other))
+                return value
+            return fn
+        with mock.patch('google.appengine.api.modules.get_versions',
+                        side_effect=overlapping('get_versions', 'get_modules', ['v1'])), \
+             mock.patch('google.appengine.api.modules.get_modules',
+                        side_effect=overlapping('get_modules', 'get_versions', ['default'])):
+            rpc = environ.get_environ_dict_async(keys=('get_versions', 'get_modules', 'SERVER_NAME'), timings=True)
+            val = rpc.get_result()
+        assert ['v1'] == val['modules']['get_versions'], repr(val)
+        assert ['default'] == val['modules']['get_modules'], repr(val)
+        assert set(['modules.get_versions', 'modules.get_modules', 'os.environ.SERVER_NAME']) == set(val['timings']), \
+            repr(val)
+
+    def test_get_environ_dict_async_error(self):
+        with mock.patch('google.appengine.api.modules.get_versions', side_effect=ValueError('boom')):
+            rpc = environ.get_environ_dict_async(keys=('get_versions',))
+            self.assertRaises(ValueError, rpc.get_result)
 
     def test_get_dot_target_name(self):
         val = environ.get_dot_target_name()
@@ -113,6 +151,64 @@ class TestEnviron(unittest.TestCase):
             val = environ.is_default_version_safe()
         assert val == False, repr(val)
 
+    def test_default_version_is_cached(self):
+        with mock.patch('google.appengine.api.modules.get_default_version',
+                        return_value='v1') as get_default_version:
+            with mock.patch('time.time', return_value=1000):
+                assert environ.is_default_version('v1')
+                assert not environ.is_default_version_safe('v2')
+            assert get_default_version.call_count == 1, get_default_version.call_count
+            # The default version is looked up again once it has expired.
+            with mock.patch('time.time', return_value=1000 + environ.DEFAULT_VERSION_TTL + 1):
+                assert environ.is_default_version('v1')
+            assert get_default_version.call_count == 2, get_default_version.call_count
+
+    def test_hostname_is_cached(self):
+        with mock.patch('google.appengine.api.modules.get_hostname',
+                        return_value='localhost') as get_hostname:
+            environ.is_host_google()
+            environ.is_host_google()
+            assert get_hostname.call_count == 1, get_hostname.call_count
+
+    def test_refresh(self):
+        with mock.patch('google.appengine.api.modules.get_default_version',
+                        return_value='v1') as get_default_version:
+            environ.is_default_version('v1')
+            environ.refresh()
+            environ.is_default_version('v1')
+            assert get_default_version.call_count == 2, get_default_version.call_count
+
+    def test_warmup(self):
+        with mock.patch.dict(os.environ, {'DEFAULT_VERSION_HOSTNAME': 'localhost:8080', 'INSTANCE_ID': 'i1'}):
+            facts = environ.warmup()
+        assert 'testbed-test' == facts['get_application_id'], repr(facts)
+        assert 'localhost:8080' == facts['get_default_version_hostname'], repr(facts)
+        assert 'i1' == facts['get_current_instance_id'], repr(facts)
+        assert 'testbed-version' == facts['get_current_version_name'], repr(facts)
+        assert 'default' == facts['get_current_module_name'], repr(facts)
+        assert facts['is_development'] is True, repr(facts)
+        assert facts['is_host_google'] is False, repr(facts)
+
+        # Environment variables removed here are restored on exit, whatever the outcome.
+        with mock.patch.dict(os.environ):
+            del os.environ['CURRENT_VERSION_ID']
+            del os.environ['SERVER_SOFTWARE']
+            with mock.patch('google.appengine.api.app_identity.get_application_id') as get_application_id, \
+                 mock.patch('google.appengine.api.app_identity.get_default_version_hostname') as get_hostname:
+                # The frozen values are used after warmup, without calling the API functions.
+                assert facts['get_application_id'] == environ.get_application_id_safe()
+                assert facts['get_default_version_hostname'] == environ.get_default_version_hostname_safe()
+                assert 'i1' == environ.get_current_instance_id_safe()
+                assert not get_application_id.called
+                assert not get_hostname.called
+            assert 'testbed-version' == environ.get_current_version_name_safe()
+            assert 'testbed-version-dot-default' == environ.get_dot_target_name_safe()
+            assert environ.is_development() is True
+            # And looked up again after refresh.
+            environ.refresh()
+            assert environ.get_current_version_name_safe() is None
+            assert environ.is_development() is False
+
     def test_get_current_version_name_safe(self):
         # The version is stored in an environment variable 'CURRENT_VERSION_ID'.
         #  If that variable isn't present then an error will be raised unless we catch it.
@@ -7,6 +7,7 @@ test_ndb_json
 Tests for `gaek` module.
 """
 
+import base64
 import datetime
 import json
 import mock
@@ -14,6 +15,7 @@ import unittest
 import cStringIO
 
 from google.appengine.ext import ndb
+from google.appengine.ext import testbed
 from nose import tools
 
 from gaek import ndb_json
@@ -24,6 +26,33 @@ __all__ = [
 ]
 
 
+class Node(ndb.Model):
+    name = ndb.StringProperty()
+    link = ndb.KeyProperty()
+
+
+class Address(ndb.Model):
+    city = ndb.StringProperty()
+    updated = ndb.DateProperty()
+
+
+class Wide(ndb.Model):
+    name = ndb.StringProperty()
+    data = ndb.BlobProperty()
+    created = ndb.DateTimeProperty()
+    tags = ndb.StringProperty(repeated=True)
+    address = ndb.StructuredProperty(Address)
+    history = ndb.LocalStructuredProperty(Address, repeated=True)
+    extra = ndb.JsonProperty()
+
+
+class CustomDict(ndb.Model):
+    name = ndb.StringProperty()
+
+    def to_dict(self, *args, **kwargs):
+      return {'custom': self.name}
+
+
 class TestNdbJson(unittest.TestCase):
 
     def setUp(self):
@@ -69,6 +98,320 @@ class TestNdbJson(unittest.TestCase):
         json_fp.close()
         ndb_json_fp.close()
 
+    def test_dump__ndb_stream(self):
+      """Assert that streamed output matches `json.dump`, for each page size and indentation."""
+      payload = [{'id': i, 'values': [i, str(i)]} for i in range(5)]
+      for indent in (None, 2):
+        for page_size in (1, 2, 5, 10):
+          json_fp = cStringIO.StringIO()
+          ndb_json_fp = cStringIO.StringIO()
+          json.dump(payload, json_fp, indent=indent)
+          ndb_json.dump(iter(payload), ndb_json_fp, indent=indent,
+                        ndb_stream=True, ndb_page_size=page_size)
+          self.assertEqual(json_fp.getvalue(), ndb_json_fp.getvalue())
+
+    def test_dump__ndb_stream_empty(self):
+      ndb_json_fp = cStringIO.StringIO()
+      ndb_json.dump(iter([]), ndb_json_fp, ndb_stream=True)
+      self.assertEqual('[]', ndb_json_fp.getvalue())
+
+    def test_dump__ndb_stream_query_pages(self):
+      """Assert that a query is fetched page by page, with the next page requested ahead."""
+      pages = {
+          None: ([{'id': 1}, {'id': 2}], 'cursor1', True),
+          'cursor1': ([{'id': 3}], None, False),
+      }
+
+      def fetch_page_async(page_size, start_cursor=None):
+        future = ndb.Future()
+        future.set_result(pages[start_cursor])
+        return future
+
+      query = mock.Mock(spec=ndb.Query)
+      query.fetch_page_async.side_effect = fetch_page_async
+      ndb_json_fp = cStringIO.StringIO()
+      ndb_json.dump(query, ndb_json_fp, ndb_stream=True, ndb_page_size=2)
+
+      self.assertEqual('[{"id": 1}, {"id": 2}, {"id": 3}]', ndb_json_fp.getvalue())
+      self.assertEqual([mock.call(2), mock.call(2, start_cursor='cursor1')],
+                       query.fetch_page_async.call_args_list)
+
+    def test_dump__ndb_stream_query_without_cursors(self):
+      """Assert that a query with an IN filter, which can't use cursors, is paged from one iterator."""
+      bed = testbed.Testbed()
+      bed.activate()
+      try:
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        ndb.put_multi([Node(name='row %d' % i) for i in range(5)])
+        query = Node.query(Node.name.IN(['row 0', 'row 2', 'row 3', 'row 4']))
+        self.assertEqual([3, 1], [len(page) for page in ndb_json._iter_pages(query, 3)])
+        ndb_json_fp = cStringIO.StringIO()
+        ndb_json.dump(query, ndb_json_fp, ndb_stream=True, ndb_page_size=3)
+        self.assertEqual(['row 0', 'row 2', 'row 3', 'row 4'],
+                         sorted(row['name'] for row in json.loads(ndb_json_fp.getvalue())))
+      finally:
+        bed.deactivate()
+
+    def test_dump_async__ndb_stream(self):
+      """Assert that the tasklet version of a streamed dump matches `json.dump`."""
+      pages = {
+          None: ([{'id': 1}, {'id': 2}], 'cursor1', True),
+          'cursor1': ([{'id': 3}], None, False),
+      }
+
+      def fetch_page_async(page_size, start_cursor=None):
+        future = ndb.Future()
+        future.set_result(pages[start_cursor])
+        return future
+
+      for indent in (None, 2):
+        query = mock.Mock(spec=ndb.Query)
+        query.fetch_page_async.side_effect = fetch_page_async
+        json_fp = cStringIO.StringIO()
+        ndb_json_fp = cStringIO.StringIO()
+        json.dump([{'id': 1}, {'id': 2}, {'id': 3}], json_fp, indent=indent)
+        future = ndb_json.dump_async(query, ndb_json_fp, indent=indent, ndb_stream=True, ndb_page_size=2)
+        future.get_result()
+        self.assertEqual(json_fp.getvalue(), ndb_json_fp.getvalue())
+
+    def test_dumps_async(self):
+      keys = [ndb.Key('Kind', i, app='test') for i in (1, 2)]
+
+      def get_multi_async(keys):
+        futures = []
+        for key in keys:
+          future = ndb.Future()
+          future.set_result({'id': key.id()})
+          futures.append(future)
+        return futures
+
+      with mock.patch.object(ndb, 'get_multi_async', side_effect=get_multi_async) as get_multi:
+        future = ndb_json.dumps_async({'keys': keys})
+        self.assertEqual('{"keys": [{"id": 1}, {"id": 2}]}', future.get_result())
+        self.assertEqual(1, get_multi.call_count)
+        future = ndb_json.dump_async({'keys': keys}, cStringIO.StringIO(), ndb_keys_as_pairs=True)
+        future.get_result()
+        self.assertEqual(1, get_multi.call_count)
+
+    def test_dump_async__ndb_key_window(self):
+      rows = [Node(name='row %d' % i, link=ndb.Key('Node', i + 1, app='test')) for i in range(3)]
+
+      def get_async(key):
+        future = ndb.Future()
+        future.set_result(Node(name='owner %d' % key.id()))
+        return future
+
+      ndb_json_fp = cStringIO.StringIO()
+      with mock.patch.object(ndb.Key, 'get_async', autospec=True, side_effect=get_async) as key_get_async:
+        # The window replaces the batching of Keys that the async API uses by default.
+        ndb_json.dump_async(rows, ndb_json_fp, ndb_stream=True, ndb_key_window=2).get_result()
+      self.assertEqual(3, key_get_async.call_count)
+      self.assertEqual(['owner 1', 'owner 2', 'owner 3'],
+                       [row['link']['name'] for row in json.loads(ndb_json_fp.getvalue())])
+
+    def test_dumps_async__query(self):
+      bed = testbed.Testbed()
+      bed.activate()
+      try:
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        ndb.put_multi([Node(name='row %d' % i) for i in range(3)])
+        query = Node.query().order(Node.name)
+        for kwargs in ({'ndb_keys_as_pairs': True}, {'ndb_keys_as_urlsafe': True}):
+          with mock.patch.object(ndb.Query, 'fetch_async', autospec=True,
+                                 side_effect=ndb.Query.fetch_async) as fetch_async:
+            json_str = ndb_json.dumps_async(query, **kwargs).get_result()
+          # The query is fetched by yielding to the event loop, whichever way Keys are encoded.
+          fetch_async.assert_called_once_with(query)
+          self.assertEqual(['row 0', 'row 1', 'row 2'], [row['name'] for row in json.loads(json_str)])
+        with mock.patch.object(ndb.QueryIterator, 'has_next_async', autospec=True,
+                               side_effect=ndb.QueryIterator.has_next_async) as has_next_async:
+          json_str = ndb_json.dumps_async(query.iter(), ndb_keys_as_urlsafe=True).get_result()
+        self.assertEqual(4, has_next_async.call_count)
+        self.assertEqual(3, len(json.loads(json_str)))
+      finally:
+        bed.deactivate()
+
+    def test_dump_async__ndb_stream_query_without_cursors(self):
+      bed = testbed.Testbed()
+      bed.activate()
+      try:
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        ndb.put_multi([Node(name='row %d' % i) for i in range(5)])
+        query = Node.query(Node.name.IN(['row 0', 'row 2', 'row 3', 'row 4']))
+        ndb_json_fp = cStringIO.StringIO()
+        ndb_json.dump_async(query, ndb_json_fp, ndb_stream=True, ndb_page_size=3).get_result()
+        self.assertEqual(['row 0', 'row 2', 'row 3', 'row 4'],
+                         sorted(row['name'] for row in json.loads(ndb_json_fp.getvalue())))
+      finally:
+        bed.deactivate()
+
+    def test_dump_lines(self):
+      payload = [{'id': 1}, {'id': 2, 'text': u'line\nbreak'}]
+      ndb_json_fp = cStringIO.StringIO()
+      ndb_json.dump_lines(iter(payload), ndb_json_fp, sort_keys=True, ndb_page_size=1)
+      self.assertEqual('{"id": 1}\n{"id": 2, "text": "line\\nbreak"}\n', ndb_json_fp.getvalue())
+
+    def test_dump__ndb_key_window(self):
+      """Assert that the Keys of the next values are fetched before the current value is written."""
+      log = []
+      rows = [Node(name='row %d' % i, link=ndb.Key('Node', i % 3 + 1, app='test')) for i in range(5)]
+
+      def get_async(key):
+        log.append(('get', key.id()))
+        future = ndb.Future()
+        future.set_result(Node(name='owner %d' % key.id()))
+        return future
+
+      ndb_json_fp = mock.Mock()
+      ndb_json_fp.write.side_effect = lambda chunk: log.append(('write', chunk))
+      with mock.patch.object(ndb.Key, 'get_async', autospec=True, side_effect=get_async):
+        ndb_json.dump_lines(rows, ndb_json_fp, ndb_key_window=2, sort_keys=True)
+
+      gets = [entry for entry in log if entry[0] == 'get']
+      self.assertEqual([('get', 1), ('get', 2), ('get', 3), ('get', 1), ('get', 2)], gets)
+      self.assertEqual(('get', 3), log[2])
+      written = ''.join(chunk for action, chunk in log if action == 'write')
+      self.assertEqual([{'name': 'row %d' % i, 'link': {'name': 'owner %d' % (i % 3 + 1), 'link': None}}
+                        for i in range(5)],
+                       [json.loads(line) for line in written.splitlines()])
+      self.assertRaises(ValueError, ndb_json.NdbEncoder, ndb_key_window=2, ndb_keys_batched=True)
+
+    def test_dump_lines_with_indent(self):
+      self.assertRaises(ValueError, ndb_json.dump_lines, [], cStringIO.StringIO(), indent=2)
+
+    def test_load_lines(self):
+      ndb_json_fp = cStringIO.StringIO('{"id": 1}\n\n{"created": "2016-01-01T12:00:00Z"}\n')
+      parsed = ndb_json.load_lines(ndb_json_fp)
+      self.assertEqual({'id': 1}, next(parsed))
+      self.assertEqual({'created': datetime.datetime(2016, 1, 1, 12)}, next(parsed))
+      self.assertRaises(StopIteration, next, parsed)
+
+    def test_load(self):
+      json_str = ' [ {"id": 12345, "name": "a, [b]"},\n{"created": "2016-01-01T12:00:00Z"}, [1.5, "]"], 67890 ] '
+      self.assertEqual(ndb_json.loads(json_str), ndb_json.load(cStringIO.StringIO(json_str)))
+      for chunk_size in (1, 3, 7, 1000):
+        parsed = ndb_json.load(cStringIO.StringIO(json_str), ndb_stream=True, ndb_chunk_size=chunk_size)
+        self.assertEqual(ndb_json.loads(json_str), list(parsed))
+
+    def test_load__ndb_stream_model(self):
+      entities = [Node(name='node %d' % i, link=ndb.Key('Node', i + 1)) for i in range(5)]
+      ndb_json_fp = cStringIO.StringIO()
+      ndb_json.dump(entities, ndb_json_fp, ndb_keys_as_pairs=True, ndb_stream=True, ndb_page_size=2)
+      ndb_json_fp.seek(0)
+      parsed = ndb_json.load(ndb_json_fp, ndb_model=Node, ndb_stream=True, ndb_chunk_size=16)
+      self.assertEqual([(e.name, e.link.pairs()) for e in entities], [(e.name, e.link.pairs()) for e in parsed])
+
+    def test_load__ndb_stream_errors(self):
+      for json_str in ('{"a": 1}', '[1, 2', '[1 2]', '[1,]', '[{"a": }]'):
+        parsed = ndb_json.load(cStringIO.StringIO(json_str), ndb_stream=True, ndb_chunk_size=2)
+        self.assertRaises(ValueError, list, parsed)
+      self.assertEqual([], list(ndb_json.load(cStringIO.StringIO(' [ ] '), ndb_stream=True)))
+
+    def test_import_entities(self):
+      error = Exception('put failed')
+
+      def put_multi_async(entities):
+        futures = []
+        for entity in entities:
+          future = ndb.Future()
+          if entity.name == 'node 3':
+            future.set_exception(error)
+          else:
+            future.set_result(ndb.Key('Node', entity.name))
+          futures.append(future)
+        return futures
+
+      json_str = ndb_json.dumps([Node(name='node %d' % i) for i in range(7)])
+      with mock.patch.object(ndb, 'put_multi_async', side_effect=put_multi_async) as put:
+        result = ndb_json.import_entities(cStringIO.StringIO(json_str), Node, batch_size=3, max_pending=2,
+                                          ndb_chunk_size=16)
+      self.assertEqual(3, put.call_count)
+      self.assertEqual(6, result.count)
+      batch_error, = result.errors
+      self.assertEqual(1, batch_error.index)
+      self.assertEqual(['node 3', 'node 4', 'node 5'], [entity.name for entity in batch_error.entities])
+      self.assertIs(error, batch_error.exception)
+
+    def test_import_entities__ndb_lines(self):
+      ndb_json_fp = cStringIO.StringIO()
+      ndb_json.dump_lines([Node(name='node %d' % i) for i in range(3)], ndb_json_fp)
+      ndb_json_fp.seek(0)
+      with mock.patch.object(ndb, 'put_multi_async', side_effect=lambda entities: []) as put:
+        ndb_json.import_entities(ndb_json_fp, Node, ndb_lines=True,
+                                 transform=lambda entity: entity if entity.name != 'node 1' else None)
+      put.assert_called_once_with(mock.ANY)
+      self.assertEqual(['node 0', 'node 2'], [entity.name for entity in put.call_args[0][0]])
+      self.assertRaises(ValueError, ndb_json.import_entities, ndb_json_fp, Node, batch_size=0)
+      self.assertRaises(ValueError, ndb_json.import_entities, ndb_json_fp, Node, ndb_lines=True, ndb_chunk_size=1024)
+
+    def test_dump_parallel(self):
+      key = ndb.Key('Node', 'owner', app='test')
+      rows = [Node(name='row %d' % i, link=key) for i in range(5)]
+      ndb_json_fp = cStringIO.StringIO()
+      ndb_json.dump_parallel(rows, ndb_json_fp, workers=2, ndb_page_size=2)
+      self.assertEqual(ndb_json.dumps(rows, ndb_keys_as_urlsafe=True), ndb_json_fp.getvalue())
+
+    def test_dump_parallel__query(self):
+      bed = testbed.Testbed()
+      bed.activate()
+      try:
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        ndb.put_multi([Node(name='row %d' % i) for i in range(5)])
+        query = Node.query().order(Node.name)
+        ndb_json_fp = cStringIO.StringIO()
+        with mock.patch.object(ndb.Query, 'fetch', autospec=True, side_effect=ndb.Query.fetch) as fetch:
+          ndb_json.dump_parallel(query, ndb_json_fp, workers=2, ndb_page_size=2)
+        # The entities are fetched by the workers, rather than by this process.
+        self.assertFalse(fetch.called)
+        self.assertEqual(ndb_json.dumps(query, ndb_keys_as_urlsafe=True), ndb_json_fp.getvalue())
+      finally:
+        bed.deactivate()
+
+    def test_dump_parallel__ndb_project_query(self):
+      bed = testbed.Testbed()
+      bed.activate()
+      try:
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        ndb.put_multi([Node(name='row %d' % i, link=ndb.Key('Node', i + 1)) for i in range(5)])
+        query = Node.query()
+        kwargs = {'ndb_include': ['name'], 'ndb_project_query': True}
+        ndb_json_fp = cStringIO.StringIO()
+        ndb_json.dump_parallel(query, ndb_json_fp, workers=2, ndb_page_size=2, **kwargs)
+        self.assertEqual([{'name': 'row %d' % i} for i in range(5)], json.loads(ndb_json_fp.getvalue()))
+      finally:
+        bed.deactivate()
+
+    def test_dump_parallel__query_without_cursors(self):
+      bed = testbed.Testbed()
+      bed.activate()
+      try:
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        ndb.put_multi([Node(name='row %d' % i) for i in range(5)])
+        query = Node.query(Node.name.IN(['row 0', 'row 2', 'row 3', 'row 4']))
+        ndb_json_fp = cStringIO.StringIO()
+        ndb_json.dump_parallel(query, ndb_json_fp, workers=2, ndb_page_size=3)
+        self.assertEqual(['row 0', 'row 2', 'row 3', 'row 4'],
+                         sorted(row['name'] for row in json.loads(ndb_json_fp.getvalue())))
+      finally:
+        bed.deactivate()
+
+    def test_dump_parallel__ndb_lines(self):
+      rows = [Node(name='row %d' % i) for i in range(3)]
+      ndb_json_fp = cStringIO.StringIO()
+      ndb_json.dump_parallel(rows, ndb_json_fp, workers=2, ndb_page_size=2, ndb_lines=True)
+      parsed = ndb_json.load_lines(cStringIO.StringIO(ndb_json_fp.getvalue()), ndb_model=Node)
+      self.assertEqual(['row 0', 'row 1', 'row 2'], [row.name for row in parsed])
+
+    def test_dump_parallel_with_keys_as_entities(self):
+      self.assertRaises(ValueError, ndb_json.dump_parallel, [], cStringIO.StringIO(),
+                        ndb_keys_as_entities=True)
+
     def test_dumps_with_subclassed_type(self):
         """ Assert that a subclass of a supported type will encode as JSON properly """
         class MyDateTime(datetime.datetime):
@@ -124,6 +467,150 @@ class TestNdbJson(unittest.TestCase):
         assert '12-15' == parsed['non-date']
         assert '12-15-0' == parsed['double-hyphen non-date']
 
+    def test_loads_with_encoded_datetime_values(self):
+        """Assert that the output of `encode_datetime` is parsed back."""
+        values = [
+            datetime.datetime(2015, 1, 1),
+            datetime.datetime(2015, 1, 1, 12, 30),
+            datetime.datetime(2015, 1, 1, 12, 30, 15),
+            datetime.datetime(2015, 1, 1, 12, 30, 15, 500),
+            datetime.datetime(2015, 1, 1, 12, 30, 15, tzinfo=ndb_json.FixedOffset(120)),
+            datetime.datetime(2015, 1, 1, 12, 30, 15, tzinfo=ndb_json.FixedOffset(-90)),
+        ]
+        for value in values:
+            parsed = ndb_json.loads(ndb_json.dumps({'value': value}))
+            tools.eq_(value, parsed['value'])
+        # Dates are decoded as datetimes.
+        parsed = ndb_json.loads(ndb_json.dumps({'value': datetime.date(2015, 1, 1)}))
+        tools.eq_(datetime.datetime(2015, 1, 1), parsed['value'])
+        parsed = ndb_json.loads('{"value": "2015-01-01T12:00:00+00:00"}')
+        assert parsed['value'].tzinfo is None
+
+    def test_loads_with_date_like_values(self):
+        """Assert that strings which only look like dates are left as strings."""
+        payload_str = json.dumps({
+            'uuid': '1234-5678-9abc-def0',
+            'slug': 'a-very-long-slug',
+            'invalid': '2015-13-45',
+            'us date': '01-05-2015',
+        })
+
+        parsed = ndb_json.loads(payload_str)
+
+        assert '1234-5678-9abc-def0' == parsed['uuid']
+        assert 'a-very-long-slug' == parsed['slug']
+        assert '2015-13-45' == parsed['invalid']
+        assert '01-05-2015' == parsed['us date']
+
+    def test_loads__ndb_lenient_dates(self):
+        """Assert that dateutil parses other date formats when asked to."""
+        parsed = ndb_json.loads(json.dumps({'us date': '01-05-2015'}), ndb_lenient_dates=True)
+        assert datetime.datetime(2015, 1, 5) == parsed['us date']
+
+    def test_loads__ndb_model(self):
+        """Assert that entities are rebuilt from their declared properties."""
+        entity = Wide(
+            name='2016-01-01',
+            data='\xff\x00blob',
+            created=datetime.datetime(2016, 1, 1, 12),
+            tags=['a', 'b'],
+            address=Address(city='Paris', updated=datetime.date(2016, 2, 1)),
+            history=[Address(city='Lyon')],
+            extra={'nested': [1, 2]})
+
+        parsed = ndb_json.loads(ndb_json.dumps(entity), ndb_model=Wide)
+
+        assert isinstance(parsed, Wide)
+        tools.eq_(entity.to_dict(), parsed.to_dict())
+
+    def test_loads__ndb_model_list_and_keys(self):
+        key = ndb.Key('Node', 'a', app='test')
+        entities = [Node(name='a', link=key), Node(name='b')]
+        for key_option in ('ndb_keys_as_urlsafe', 'ndb_keys_as_pairs'):
+          json_str = ndb_json.dumps(entities, **{key_option: True})
+          parsed = ndb_json.loads(json_str, ndb_model=Node)
+          tools.eq_(['a', 'b'], [entity.name for entity in parsed])
+          tools.eq_([key.pairs(), None], [entity.link and entity.link.pairs() for entity in parsed])
+
+    def test_loads__ndb_model_expando_computed(self):
+        """Assert that the values of computed properties are not set on an Expando."""
+        class Tagged(ndb.Expando):
+          name = ndb.StringProperty()
+          upper = ndb.ComputedProperty(lambda self: self.name.upper())
+
+        parsed = ndb_json.loads(ndb_json.dumps(Tagged(name='tag', color='red')), ndb_model=Tagged)
+        tools.eq_({'name': 'tag', 'upper': 'TAG', 'color': 'red'}, parsed.to_dict())
+
+    def test_dumps__ndb_keys_as_interned(self):
+        parent = ndb.Key('Node', 'a')
+        keys = [ndb.Key('Node', 'a', 'Node', 'b'), ndb.Key('Node', 'a', 'Node', 1), parent]
+        entities = [Node(name='b', link=keys[0]), Node(name='c', link=keys[1]), Node(name='d', link=keys[0])]
+        json_str = ndb_json.dumps(entities, ndb_keys_as_interned=True, sort_keys=True)
+        doc = json.loads(json_str)
+        tools.eq_({'kinds': ['Node'], 'paths': [[0, 'a'], [0, 0, 'b'], [0, 0, 1]]}, doc['__ndb_keys__'])
+        tools.eq_({'__ndb_key__': 1}, doc['__ndb_data__'][2]['link'])
+        tools.eq_(json_str, ndb_json.dumps(entities, ndb_keys_as_interned=True, sort_keys=True))
+        tools.eq_([key.pairs() for key in keys[:2]],
+                  [value['link'].pairs() for value in ndb_json.loads(json_str)[:2]])
+        parsed = ndb_json.loads(json_str, ndb_model=Node)
+        tools.eq_(keys[1].pairs(), parsed[1].link.pairs())
+        # The document is still valid JSON when indented.
+        tools.eq_(doc, json.loads(ndb_json.dumps(entities, ndb_keys_as_interned=True, sort_keys=True, indent=2)))
+
+    def test_invalid_arguments__ndb_keys_as_interned(self):
+        tools.assert_raises(ValueError, ndb_json.NdbEncoder, ndb_keys_as_interned=True, ndb_keys_as_pairs=True)
+        tools.assert_raises(ValueError, ndb_json.NdbEncoder, ndb_keys_as_interned=True, ndb_keys_batched=True)
+        tools.assert_raises(ValueError, ndb_json.dump, [], cStringIO.StringIO(), ndb_keys_as_interned=True,
+                            ndb_stream=True)
+
+    def test_loads__ndb_blobs(self):
+        entity = Wide(name='wide', data='\xff\x00blob')
+        json_str = ndb_json.dumps(entity, ndb_blobs=lambda entity, name, value: 'ref:' + name)
+        parsed = ndb_json.loads(json_str, ndb_model=Wide, ndb_blobs=lambda ref: str(ref.upper()))
+        tools.eq_('REF:DATA', parsed.data)
+        tools.assert_raises(ValueError, ndb_json.NdbDecoder, ndb_blobs='omit')
+
+    def test_dumps__ndb_backend_parity(self):
+        """Assert that every installed JSON backend encodes the same values as the default encoder."""
+        payload = [
+            Wide(name=u'(\u256f\xb0\u25a1\xb0)', data='\xff\x00', created=datetime.datetime(2016, 1, 1),
+                 tags=['a/b'], address=Address(city='Paris')),
+            {'complex': 1 + 2j, 'tuple': (1, 2), 'float': 1.5, 'none': None, 'bool': True},
+        ]
+        expected = ndb_json.dumps(payload, sort_keys=True)
+        tools.eq_(expected, ndb_json.dumps(payload, sort_keys=True, ndb_backend='json'))
+        for name in ndb_json.JSON_BACKENDS:
+          output = ndb_json.dumps(payload, sort_keys=True, ndb_backend=name)
+          tools.eq_(json.loads(expected), json.loads(output))
+
+    def test_dump__ndb_backend_parity(self):
+        payload = [{'id': 1, 'created': datetime.datetime(2016, 1, 1)}, {'id': 2}]
+        for name in ndb_json.JSON_BACKENDS:
+          for stream in (False, True):
+            ndb_json_fp = cStringIO.StringIO()
+            ndb_json.dump(payload, ndb_json_fp, ndb_backend=name, ndb_stream=stream)
+            tools.eq_(json.loads(ndb_json.dumps(payload)), json.loads(ndb_json_fp.getvalue()))
+
+    def test_loads__ndb_backend_parity(self):
+        """Assert that every installed JSON backend decodes the same values as the default decoder."""
+        test_cases = [
+            '{"nested": {"datetime": "2016-01-01T12:00:00Z"}, "list": [{"date": "2016-01-01"}]}',
+            '[1, 2.5, "str", null, true]',
+            '2015-01-01',
+        ]
+        for s in test_cases:
+          for name in ndb_json.JSON_BACKENDS:
+            tools.eq_(ndb_json.loads(s), ndb_json.loads(s, ndb_backend=name))
+        json_str = ndb_json.dumps(Address(city='Paris', updated=datetime.date(2016, 2, 1)))
+        for name in ndb_json.JSON_BACKENDS:
+          parsed = ndb_json.loads(json_str, ndb_model=Address, ndb_backend=name)
+          tools.eq_(datetime.date(2016, 2, 1), parsed.updated)
+
+    def test_get_json_backend(self):
+        tools.eq_('json', ndb_json.get_json_backend('json').name)
+        assert ndb_json.get_json_backend('auto').name in ndb_json.JSON_BACKENDS
+        self.assertRaises(ValueError, ndb_json.get_json_backend, 'missing')
+
     def test_loads_with_nested_datetime(self):
         """Assert the object hooks work as intended."""
         payload_str = json.dumps({
@@ -154,6 +641,20 @@ class TestNdbJson(unittest.TestCase):
                         ndb_keys_as_pairs=True,
                         ndb_keys_as_urlsafe=False)
 
+    def test_invalid_arguments__ndb_keys_batched(self):
+      self.assertRaises(ValueError,
+                        ndb_json.NdbEncoder,
+                        ndb_keys_batched=True,
+                        ndb_keys_as_pairs=True)
+      self.assertRaises(ValueError,
+                        ndb_json.NdbEncoder,
+                        ndb_keys_batched=True,
+                        ndb_keys_as_urlsafe=True)
+      self.assertRaises(ValueError,
+                        ndb_json.NdbEncoder,
+                        ndb_keys_memo=True,
+                        ndb_keys_as_pairs=True)
+
     def test_encode_key(self):
       some_obj = mock.Mock()
       ndb_json.encode_key(some_obj)
@@ -217,6 +718,324 @@ class TestNdbJson(unittest.TestCase):
       dump = ndb_json.dumps(obj, sort_keys=True, ndb_keys_as_urlsafe=True)
       self.assertEqual('{"key": "urlsafe", "number": 1, "string": "is here"}', dump)
 
+    def test_dumps__ndb_keys_batched(self):
+      keys = [ndb.Key('Kind', i, app='test') for i in (1, 2)]
+
+      def get_multi_async(keys):
+        futures = []
+        for key in keys:
+          future = ndb.Future()
+          future.set_result({'id': key.id()})
+          futures.append(future)
+        return futures
+
+      with mock.patch.object(ndb, 'get_multi_async', side_effect=get_multi_async) as get_multi:
+        dump = ndb_json.dumps({'keys': keys}, ndb_keys_batched=True)
+
+      self.assertEqual(1, get_multi.call_count)
+      self.assertEqual('{"keys": [{"id": 1}, {"id": 2}]}', dump)
+
+    def test_dumps__ndb_keys_batched_falls_back_for_unknown_keys(self):
+      obj = {
+        "key": self.ndb_mock
+      }
+
+      dump = ndb_json.dumps(obj, ndb_keys_batched=True)
+      self.assertEqual('{"key": "get_async"}', dump)
+
+    def test_dumps__ndb_keys_memo_fetches_each_key_once(self):
+      owner_key = ndb.Key('Node', 'owner', app='test')
+      entities = {owner_key: Node(key=owner_key, name='owner')}
+      rows = [Node(name='row %d' % i, link=owner_key) for i in range(3)]
+
+      def get_async(key):
+        future = ndb.Future()
+        future.set_result(entities[key])
+        return future
+
+      with mock.patch.object(ndb.Key, 'get_async', autospec=True, side_effect=get_async) as get:
+        dump = ndb_json.dumps(rows, ndb_keys_memo=True)
+
+      self.assertEqual(1, get.call_count)
+      parsed = json.loads(dump)
+      self.assertEqual([{'link': None, 'name': 'owner'}] * 3, [row['link'] for row in parsed])
+
+    def test_dumps__ndb_keys_memo_breaks_cycles(self):
+      key_a = ndb.Key('Node', 'a', app='test')
+      key_b = ndb.Key('Node', 'b', app='test')
+      entities = {
+        key_a: Node(key=key_a, name='a', link=key_b),
+        key_b: Node(key=key_b, name='b', link=key_a),
+      }
+
+      def get_async(key):
+        future = ndb.Future()
+        future.set_result(entities[key])
+        return future
+
+      with mock.patch.object(ndb.Key, 'get_async', autospec=True, side_effect=get_async):
+        dump = ndb_json.dumps(entities[key_a], ndb_keys_memo=True)
+        pairs_dump = ndb_json.dumps(entities[key_a], ndb_keys_memo=True,
+                                    ndb_keys_fallback=ndb_json.encode_key_as_pair)
+
+      expected = {'name': 'a', 'link': {'name': 'b', 'link': key_a.urlsafe()}}
+      self.assertEqual(expected, json.loads(dump))
+      expected = {'name': 'a', 'link': {'name': 'b', 'link': [['Node', 'a']]}}
+      self.assertEqual(expected, json.loads(pairs_dump))
+
+    def test_dumps__ndb_keys_max_depth(self):
+      key_a = ndb.Key('Node', 'a', app='test')
+      entity = Node(name='root', link=key_a)
+
+      dump = ndb_json.dumps(entity, ndb_keys_memo=True, ndb_keys_max_depth=0)
+      self.assertEqual({'name': 'root', 'link': key_a.urlsafe()}, json.loads(dump))
+
+    def test_dumps__ndb_keys_max_depth_batched(self):
+      keys = [ndb.Key('Node', 'n%d' % i, app='test') for i in range(7)]
+      entities = {key: Node(key=key, name=key.id(), link=next_key) for key, next_key in zip(keys, keys[1:])}
+
+      def get_multi_async(keys):
+        futures = []
+        for key in keys:
+          future = ndb.Future()
+          future.set_result(entities[key])
+          futures.append(future)
+        return futures
+
+      with mock.patch.object(ndb, 'get_multi_async', side_effect=get_multi_async) as get_multi:
+        dump = ndb_json.dumps(entities[keys[0]], ndb_keys_memo=True, ndb_keys_batched=True, ndb_keys_max_depth=1)
+
+      # Only the level of Keys expanded within the depth limit is fetched.
+      get_multi.assert_called_once_with([keys[1]])
+      self.assertEqual({'name': 'n0', 'link': {'name': 'n1', 'link': keys[2].urlsafe()}}, json.loads(dump))
+
+    def test_dumps_with_model_values(self):
+      entity = Wide(
+          name=u'wide \u2713',
+          data='\xff\x00blob',
+          created=datetime.datetime(2016, 1, 1, 12),
+          tags=['a', 'b'],
+          address=Address(city='Paris', updated=datetime.date(2016, 2, 1)),
+          history=[Address(city='Lyon')],
+          extra={'nested': [1, 2]})
+
+      parsed = json.loads(ndb_json.dumps(entity))
+
+      self.assertEqual({
+          'name': u'wide \u2713',
+          'data': '/wBibG9i',
+          'created': '2016-01-01T12:00:00Z',
+          'tags': ['a', 'b'],
+          'address': {'city': 'Paris', 'updated': '2016-02-01'},
+          'history': [{'city': 'Lyon', 'updated': None}],
+          'extra': {'nested': [1, 2]},
+      }, parsed)
+
+    def test_dumps_with_model_matches_to_dict(self):
+      entity = Address(city='Paris', updated=datetime.date(2016, 2, 1))
+      self.assertEqual(ndb_json.dumps(entity.to_dict(), sort_keys=True),
+                       ndb_json.dumps(entity, sort_keys=True))
+
+    def test_dumps_with_custom_to_dict(self):
+      self.assertEqual('{"custom": "name"}', ndb_json.dumps(CustomDict(name='name')))
+
+    def test_dumps_with_large_blob(self):
+      data = ''.join(chr(i % 256) for i in range(ndb_json.BLOB_CHUNK_SIZE * 2 + 5))
+      entity = Wide(name='wide', data=data)
+      for kwargs in ({}, {'ndb_backend': 'json'}, {'ndb_keys_memo': True}):
+        parsed = json.loads(ndb_json.dumps([entity, entity], **kwargs))
+        self.assertEqual([base64.b64encode(data)] * 2, [row['data'] for row in parsed])
+      self.assertEqual(data, ndb_json.loads(ndb_json.dumps(entity), ndb_model=Wide).data)
+
+    def test_dumps_with_small_blob(self):
+      entity = Wide(name='wide', data='\xff\x00blob')
+      with mock.patch('gaek.ndb_json.iter_base64', side_effect=ndb_json.iter_base64) as iter_base64:
+        parsed = json.loads(ndb_json.dumps(entity))
+      # Blobs smaller than one chunk are encoded at once, rather than spliced into the output.
+      self.assertFalse(iter_base64.called)
+      self.assertEqual(base64.b64encode('\xff\x00blob'), parsed['data'])
+
+    def test_iter_base64(self):
+      data = ''.join(chr(i % 256) for i in range(ndb_json.BLOB_CHUNK_SIZE * 2 + 5))
+      chunks = list(ndb_json.iter_base64(data))
+      self.assertEqual(3, len(chunks))
+      self.assertEqual(base64.b64encode(data), ''.join(chunks))
+      self.assertEqual(data, ndb_json.decode_blob(unicode(''.join(chunks))))
+
+    def test_dumps__ndb_blobs(self):
+      entity = Wide(name='wide', data='\xff\x00blob', history=[Address(city='Lyon')])
+      dump = ndb_json.dumps(entity, ndb_blobs='omit', ndb_include=['name', 'data'])
+      self.assertEqual('{"name": "wide"}', dump)
+      dump = ndb_json.dumps(entity, ndb_blobs=lambda entity, name, value: {'size': len(value)},
+                            ndb_include=['data'])
+      self.assertEqual('{"data": {"size": 6}}', dump)
+      self.assertRaises(ValueError, ndb_json.NdbEncoder, ndb_blobs='hex')
+
+    def test_dumps__ndb_blobs_omit_expando(self):
+      class Attachment(ndb.Expando):
+        data = ndb.BlobProperty()
+
+      entity = Attachment(data='\xff\x00blob', title='notes')
+      self.assertEqual({'title': 'notes'}, json.loads(ndb_json.dumps(entity, ndb_blobs='omit')))
+
+    def test_get_model_serializer_is_cached(self):
+      self.assertIs(ndb_json.get_model_serializer(Wide), ndb_json.get_model_serializer(Wide))
+
+    def test_dumps__ndb_include(self):
+      entity = Wide(name='wide', data='blob', tags=['a'], address=Address(city='Paris'))
+      dump = ndb_json.dumps(entity, ndb_include=['name', 'tags'], sort_keys=True)
+      self.assertEqual('{"name": "wide", "tags": ["a"]}', dump)
+
+    def test_dumps__ndb_include_and_exclude_by_kind(self):
+      rows = [Node(name='node'), Address(city='Paris', updated=datetime.date(2016, 2, 1))]
+      dump = ndb_json.dumps(rows, ndb_include={'Node': ['name']}, ndb_exclude={'Address': ['updated']})
+      self.assertEqual([{'name': 'node'}, {'city': 'Paris'}], json.loads(dump))
+      dump = ndb_json.dumps(CustomDict(name='name'), ndb_exclude=['custom'])
+      self.assertEqual('{}', dump)
+
+    def test_dumps__ndb_include_skips_unselected_keys(self):
+      rows = [Node(name='row', link=ndb.Key('Node', 'owner', app='test'))]
+      with mock.patch.object(ndb, 'get_multi_async') as get_multi:
+        dump = ndb_json.dumps(rows, ndb_include=['name'], ndb_keys_batched=True)
+      self.assertEqual(0, get_multi.call_count)
+      self.assertEqual('[{"name": "row"}]', dump)
+
+    def test_dumps__ndb_include_fetches_keys_of_structured_models(self):
+      class Route(ndb.Model):
+        name = ndb.StringProperty()
+        stop = ndb.StructuredProperty(Node)
+
+      key = ndb.Key('Node', 'owner', app='test')
+
+      def get_multi_async(keys):
+        future = ndb.Future()
+        future.set_result(Node(name='owner'))
+        return [future]
+
+      with mock.patch.object(ndb, 'get_multi_async', side_effect=get_multi_async) as get_multi:
+        dump = ndb_json.dumps(Route(name='route', stop=Node(name='stop', link=key)),
+                              ndb_include=['name', 'stop'], ndb_keys_batched=True)
+      # The nested Node is encoded whole, so its Key is fetched with the batch. The fetched Node is a
+      # Node entity, so it is encoded with the selection.
+      get_multi.assert_called_once_with([key])
+      self.assertEqual({'name': 'route', 'stop': {'name': 'stop', 'link': {'name': 'owner'}}}, json.loads(dump))
+
+    def test_invalid_arguments__ndb_include(self):
+      self.assertRaises(ValueError, ndb_json.NdbEncoder, ndb_include='name')
+      self.assertRaises(ValueError, ndb_json.NdbEncoder, ndb_project_query=True)
+
+    def test_project_query(self):
+      encoder = ndb_json.NdbEncoder(ndb_include={'Node': ['name'], 'Wide': ['name', 'tags']},
+                                    ndb_project_query=True)
+      self.assertEqual(('name',), encoder._project_query(Node.query()).projection)
+      # Repeated properties can't be projected, nor properties filtered for equality.
+      self.assertFalse(encoder._project_query(Wide.query()).projection)
+      self.assertFalse(encoder._project_query(Node.query(Node.name == 'a')).projection)
+      self.assertEqual(('name',), encoder._project_query(Node.query(Node.name > 'a')).projection)
+
+    def test_dumps__ndb_cache(self):
+      cache = ndb_json.FragmentCache(use_memcache=False, version='name')
+      node = Node(key=ndb.Key('Node', 1), name='a')
+      expected = ndb_json.dumps([node, {'n': 1}], ndb_keys_as_urlsafe=True)
+      self.assertEqual(expected, ndb_json.dumps([node, {'n': 1}], ndb_keys_as_urlsafe=True, ndb_cache=cache))
+      # The cached fragment is used while the version is unchanged, and re-encoded once it changes.
+      with mock.patch.object(ndb_json.ModelSerializer, '__call__') as serialize:
+        self.assertEqual(expected, ndb_json.dumps([node, {'n': 1}], ndb_keys_as_urlsafe=True, ndb_cache=cache))
+        self.assertFalse(serialize.called)
+      node = Node(key=node.key, name='b')
+      self.assertIn('"name": "b"', ndb_json.dumps(node, ndb_keys_as_urlsafe=True, ndb_cache=cache))
+      # Fragments are not shared between encoder options.
+      self.assertIn('"name":"b"', ndb_json.dumps(node, ndb_keys_as_urlsafe=True, ndb_cache=cache,
+                                                 separators=(',', ':')))
+
+    def test_fragment_cache_memcache(self):
+      cache = ndb_json.FragmentCache(version='name')
+      key = ndb.Key('Node', 1)
+      with mock.patch.object(ndb_json, 'memcache') as memcache:
+        memcache.get_multi.return_value = {}
+        ndb_json.dumps([Node(key=key, name='a')], ndb_keys_as_pairs=True, ndb_cache=cache)
+        cache_key, = memcache.get_multi.call_args[0][0]
+        self.assertEqual((cache_key,), tuple(memcache.set_multi.call_args[0][0]))
+        self.assertEqual(key, ndb.Key(urlsafe=cache_key.split(':')[1]))
+        cache.invalidate(key)
+        memcache.delete_multi.assert_called_once_with([cache_key], namespace='gaek.ndb_json')
+        self.assertIsNone(cache.get(cache_key, 'a'))
+
+    def test_invalid_arguments__ndb_cache(self):
+      self.assertRaises(TypeError, ndb_json.FragmentCache)
+      self.assertRaises(ValueError, ndb_json.FragmentCache, version=None)
+      cache = ndb_json.FragmentCache(version='updated')
+      self.assertRaises(ValueError, ndb_json.NdbEncoder, ndb_cache=cache)
+      self.assertRaises(ValueError, ndb_json.NdbEncoder, ndb_cache=cache, ndb_keys_as_pairs=True, indent=2)
+
+    def test_dumps__ndb_stats(self):
+      stats = ndb_json.NdbStats()
+
+      def get_async(key):
+        future = ndb.Future()
+        future.set_result(Node(key=key, name='linked'))
+        return future
+
+      with mock.patch.object(ndb.Key, 'get_async', autospec=True, side_effect=get_async):
+        json_str = ndb_json.dumps({'created': datetime.datetime(2016, 1, 1), 'link': ndb.Key('Node', 1, app='test'),
+                                   'node': Wide(data='\x00' * ndb_json.BLOB_CHUNK_SIZE)}, ndb_stats=stats)
+      self.assertEqual(1, stats.counts['datetime'])
+      self.assertEqual(1, stats.counts['Key'])
+      self.assertEqual(1, stats.counts['Wide'])
+      self.assertEqual(1, stats.rpcs)
+      self.assertEqual(len(json_str), stats.bytes_encoded)
+      self.assertTrue({'encode_datetime', 'encode_key_as_entity', 'iter_base64'}.issubset(stats.times))
+      self.assertEqual(set(['counts', 'times', 'rpcs', 'wait_time', 'bytes_encoded', 'bytes_decoded']),
+                       set(stats.as_dict()))
+
+    def test_ndb_stats_context(self):
+      callback = mock.Mock()
+      json_str = '{"created": "2016-01-01T12:00:00Z"}'
+      with ndb_json.NdbStats(callback=callback) as stats:
+        ndb_json.loads(json_str)
+        callback.assert_not_called()
+      callback.assert_called_once_with(stats)
+      self.assertEqual(len(json_str), stats.bytes_decoded)
+      self.assertIn('decode_date', stats.times)
+      # Without stats, the encoder functions are not wrapped.
+      encoder = ndb_json.NdbEncoder()
+      self.assertIsNone(encoder._stats)
+      self.assertIs(ndb_json.encode_datetime, encoder._ndb_type_encoding[datetime.datetime])
+
+    def test_default_caches_resolved_type(self):
+      class MyDateTime(datetime.datetime):
+        pass
+
+      encoder = ndb_json.NdbEncoder()
+      encoder.default(MyDateTime(2015, 10, 1))
+      self.assertEqual(ndb_json.encode_datetime, encoder._type_cache[MyDateTime])
+
+    def test_register(self):
+      class Point(object):
+        def __init__(self, x, y):
+          self.x, self.y = x, y
+
+      class Point3D(Point):
+        pass
+
+      encoder = ndb_json.NdbEncoder()
+      self.assertRaises(TypeError, encoder.encode, Point(1, 2))
+      encoder.register(Point, lambda p: [p.x, p.y])
+      self.assertEqual('[1, 2]', encoder.encode(Point3D(1, 2)))
+      # Other encoders are not affected.
+      self.assertRaises(TypeError, ndb_json.dumps, Point(1, 2))
+
+    def test_register_type_encoder(self):
+      class Point(object):
+        pass
+
+      try:
+        with mock.patch.dict(ndb_json.NDB_TYPE_ENCODING):
+          ndb_json.register_type_encoder(Point, lambda p: 'point')
+          self.assertEqual('"point"', ndb_json.dumps(Point()))
+      finally:
+        ndb_json.NDB_TYPES[:] = ndb_json._sort_types(ndb_json.NDB_TYPE_ENCODING)
+
     def test_loads_with_primitive_values(self):
         """Assert that primitive values are parsed properly."""
         test_cases = ['null', '2', 'Infinity', '1.2345']
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_ndb_msgpack
+----------------------------------
+
+Tests for `gaek.ndb_msgpack` module.
+"""
+
+import cStringIO
+import datetime
+import unittest
+
+from google.appengine.ext import ndb
+
+from gaek import ndb_json
+from gaek import ndb_msgpack
+
+
+__all__ = [
+  'TestNdbMsgpack',
+]
+
+
+class Address(ndb.Model):
+    city = ndb.StringProperty()
+    updated = ndb.DateProperty()
+
+
+class Record(ndb.Model):
+    name = ndb.StringProperty()
+    data = ndb.BlobProperty()
+    created = ndb.DateTimeProperty()
+    owner = ndb.KeyProperty()
+    address = ndb.StructuredProperty(Address)
+
+
+class TestNdbMsgpack(unittest.TestCase):
+
+    def setUp(self):
+      self.record = Record(
+          name=u'r\xe9cord', data='\x00\xff' * 8, created=datetime.datetime(2016, 1, 2, 3, 4, 5, 678),
+          owner=ndb.Key('User', 1), address=Address(city=u'Paris', updated=datetime.date(2015, 12, 31)))
+
+    def test_roundtrip_native_values(self):
+      value = {
+          'datetime': datetime.datetime(1969, 7, 20, 20, 17, 40, 1),
+          'date': datetime.date(2016, 2, 29),
+          'key': ndb.Key('User', 1, 'Post', 'a'),
+          'blob': '\x00\xff',
+          'text': u'☃',
+          'list': [1, 2.5, None, True],
+      }
+      self.assertEqual(value, ndb_msgpack.loads(ndb_msgpack.dumps(value)))
+
+    def test_roundtrip_aware_datetime(self):
+      dt = datetime.datetime(2016, 1, 2, 3, 4, 5, tzinfo=ndb_json.FixedOffset(-330))
+      decoded = ndb_msgpack.loads(ndb_msgpack.dumps(dt))
+      self.assertEqual(dt, decoded)
+      self.assertEqual(dt.utcoffset(), decoded.utcoffset())
+
+    def test_dumps_model(self):
+      decoded = ndb_msgpack.loads(ndb_msgpack.dumps(self.record))
+      self.assertEqual(self.record.created, decoded['created'])
+      self.assertEqual(self.record.data, decoded['data'])
+      self.assertEqual(self.record.owner, decoded['owner'])
+      self.assertEqual({'city': u'Paris', 'updated': datetime.date(2015, 12, 31)}, decoded['address'])
+
+    def test_dumps__ndb_keys_as_pairs(self):
+      decoded = ndb_msgpack.loads(ndb_msgpack.dumps(self.record, ndb_keys_as_pairs=True))
+      self.assertEqual([['User', 1]], decoded['owner'])
+
+    def test_dumps__ndb_blobs_omit(self):
+      self.assertNotIn('data', ndb_msgpack.loads(ndb_msgpack.dumps(self.record, ndb_blobs='omit')))
+
+    def test_loads__ndb_model(self):
+      fp = cStringIO.StringIO()
+      ndb_msgpack.dump([self.record], fp)
+      entity, = ndb_msgpack.loads(fp.getvalue(), ndb_model=Record)
+      self.assertIsInstance(entity, Record)
+      self.assertEqual(self.record.created, entity.created)
+      self.assertEqual(self.record.data, entity.data)
+      self.assertEqual(self.record.owner, entity.owner)
+      self.assertEqual(u'Paris', entity.address.city)
+
+    def test_invalid_arguments(self):
+      self.assertRaises(ValueError, ndb_msgpack.MsgpackEncoder, ndb_backend='json')
+      self.assertRaises(ValueError, ndb_msgpack.loads, '\xc0', ndb_blobs='omit')
+
+
+if __name__ == '__main__':
+    unittest.main()